@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarky pre CPU narocne casti aplikacie, spustat napr.:
+
+   python bench.py merge --count 10000
+"""
+
+from model import Publication, Author, Identifier, URL, Index
+import random
+import time
+import json
+import gc
+import os
+import resource
+import threading
+
+def timed(fn, *args, **kwargs):
+  start = time.time()
+  result = fn(*args, **kwargs)
+  return time.time() - start, result
+
+def synthetic_citations(count, duplicate_ratio=0.3, seed=42):
+  """Vyrobi zoznam citacii, kde cast z nich su duplikaty s mierne inym zapisom"""
+  rnd = random.Random(seed)
+  surnames = [u'Novák', u'Smith', u'Vinař', u'Brejová', u'Müller', u'de Sousa', u'McDonald']
+  pubs = []
+  while len(pubs) < count:
+    i = len(pubs)
+    # normalize zahadzuje cislice, takze nazvy musia byt rozne v pismenach
+    title = u' '.join(u''.join(rnd.choice(u'abcdefghijklmnopqrstuvwxyz') for _ in range(6)) for _ in range(4))
+    authors = [Author(rnd.choice(surnames), [rnd.choice(u'ABCDEFGH') + u'.']) for _ in range(rnd.randint(1, 5))]
+    pub = Publication(title, authors, rnd.randint(1990, 2014), published_in=u'Journal {}'.format(i % 50),
+      pages=u'{}-{}'.format(i, i + 10), volume=unicode(i % 30))
+    pub.identifiers.append(Identifier(u'WOS:{:015d}'.format(i), type='WOK'))
+    pub.identifiers.append(Identifier(u'{:04d}-{:04d}'.format(i % 50, i % 7), type='ISSN'))
+    pub.source_urls.append(URL(u'http://example.com/record/{}'.format(i), type='WOK', description=u'Web of Science®'))
+    pub.indexes.append(Index(rnd.choice(['SCI', 'SSCI', 'CPCI-S']), type='WOS'))
+    pubs.append(pub)
+    if rnd.random() < duplicate_ratio:
+      dup = Publication(title.upper(), list(authors), pub.year, published_in=pub.published_in.upper(),
+        pages=pub.pages, volume=pub.volume)
+      dup.identifiers.append(Identifier(u'2-s2.0-{}'.format(i), type='SCOPUS'))
+      pubs.append(dup)
+  rnd.shuffle(pubs)
+  return pubs[:count]
+
+def quadratic_duplicates(publications):
+  """Povodny algoritmus z MergeConnection.search_citations, na porovnanie"""
+  cit = list(publications)
+  buckets = []
+  while len(cit) > 0:
+    cur = cit.pop(0)
+    bucket = [cur]
+    for i in xrange(len(cit) - 1, -1, -1):
+      if cit[i] == cur:
+        bucket.append(cit[i])
+        del cit[i]
+    buckets.append(bucket)
+  return buckets
+
+def bench_merge(args):
+  from merge import find_duplicates
+  pubs = synthetic_citations(args.count)
+  pubs.sort(key=lambda r: r.title)
+  pubs.sort(key=lambda r: r.year)
+  t, buckets = timed(find_duplicates, pubs)
+  print 'find_duplicates: {} publications -> {} buckets in {:.3f}s'.format(len(pubs), len(buckets), t)
+  if args.reference:
+    tref, ref = timed(quadratic_duplicates, pubs)
+    print 'quadratic:       {} publications -> {} buckets in {:.3f}s'.format(len(pubs), len(ref), tref)
+    same = [[id(p) for p in b] for b in buckets] == [[id(p) for p in b] for b in ref]
+    print 'same result: {}, speedup {:.1f}x'.format(same, tref / max(t, 1e-9))
+
+class FakeClock(object):
+  """Hodiny pre benchmark throttlera, sleep len posunie cas"""
+  def __init__(self, step):
+    self.now = 0.0
+    self.step = step
+    self._lock = threading.Lock()
+  
+  def __call__(self):
+    with self._lock:
+      self.now += self.step
+      return self.now
+  
+  def sleep(self, sec):
+    with self._lock:
+      self.now += sec
+
+def list_throttler_class():
+  """Povodny ThreadingThrottler s historiou v liste, na porovnanie"""
+  from throttle import Throttler, ThrottleInstance
+  
+  def max_or_none(seq):
+    if len(seq) == 0:
+      return None
+    return max(seq)
+  
+  class ListThrottler(Throttler):
+    def __init__(self, *args, **kwargs):
+      super(ListThrottler, self).__init__(*args, **kwargs)
+      self.history = []
+      self._lock = threading.Lock()
+    
+    def _acquire(self):
+      with self._lock:
+        now = self._clock()
+        while len(self.history) > 0 and self.history[0].started_before(now - self.period):
+          self.history.pop(0)
+        max_finished = max_or_none([x.finished_time for x in self.history if x != None])
+        max_started = max_or_none([x.started_time for x in self.history if x != None])
+        if len(self.history) == self.number:
+          min_started = self.history[0].started_time
+          wait_until = max(min_started + self.period + self.period_delay, max_started + self.min_delay)
+          if max_finished:
+            wait_until = max(wait_until, max_finished + self.finished_delay)
+          return None, wait_until
+        if len(self.history):
+          wait_until = max_started + self.min_delay
+          if max_finished:
+            wait_until = max(wait_until, max_finished + self.finished_delay)
+          our_request = max(wait_until, now)
+        else:
+          wait_until = None
+          our_request = now
+        result = ThrottleInstance(self, our_request)
+        self.history.append(result)
+        return result, wait_until
+    
+    def finished(self, inst):
+      with self._lock:
+        inst.finished_time = self._clock()
+  
+  return ListThrottler
+
+def bench_throttle(args):
+  from throttle import ThreadingThrottler
+  
+  def run(cls):
+    clock = FakeClock(args.step)
+    throttler = cls(args.number, args.period, sleep=clock.sleep, clock=clock)
+    def worker():
+      for i in range(args.requests):
+        with throttler():
+          pass
+    threads = [threading.Thread(target=worker) for i in range(args.threads)]
+    start = time.time()
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    return time.time() - start, len(throttler.history)
+  
+  total = args.threads * args.requests
+  for name, cls in [('deque+heap', ThreadingThrottler), ('list', list_throttler_class())]:
+    t, history = run(cls)
+    print '{:10} {} requests in {:.3f}s ({:.0f}/s), final history {}'.format(name, total, t, total / t, history)
+
+def rss():
+  """Aktualna velkost rezidentnej pamate procesu v bajtoch"""
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[1]) * resource.getpagesize()
+  except IOError:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def bench_memory(args):
+  """Nacita velky cachovany zoznam publikacii tak, ako to robi RedisCachedConnection"""
+  cached = json.dumps([pub.to_dict() for pub in synthetic_citations(args.count)], sort_keys=True)
+  dicts = json.loads(cached)
+  del cached
+  gc.collect()
+  before = rss()
+  t, pubs = timed(lambda: [Publication.from_dict(d) for d in dicts])
+  gc.collect()
+  used = rss() - before
+  print 'from_dict: {} publications in {:.3f}s, {:.1f} MB, {:.0f} B/publication'.format(
+    len(pubs), t, used / 1024.0 / 1024, float(used) / len(pubs))
+
+def bench_codec(args):
+  import codec
+  pubs = synthetic_citations(args.count)
+  codecs = [('json', codec.JSONCodec()), ('marshal', codec.MarshalCodec(compression=None)),
+            ('marshal+zlib', codec.MarshalCodec(compression='zlib'))]
+  if codec.lz4 is not None:
+    codecs.append(('marshal+lz4', codec.MarshalCodec(compression='lz4')))
+  for name, c in codecs:
+    tdump, data = timed(c.dumps, pubs)
+    tload, loaded = timed(c.loads, data)
+    assert len(loaded) == len(pubs)
+    print '{:14} {:8.0f} KB  dumps {:.3f}s  loads {:.3f}s'.format(name, len(data) / 1024.0, tdump, tload)
+
+def bench_html(args):
+  """Porovna lxml a html5lib na ulozenych strankach (napr. Scopus vysledky a export formular)
+     a skontroluje, ze formulare z oboch stromov davaju rovnake parametre
+  """
+  import htmlpage
+  from htmlform import HTMLForm
+  for path in args.pages:
+    with open(path) as f:
+      text = f.read().decode('UTF-8')
+    times = []
+    forms = []
+    for parse in [htmlpage.parse_fast, htmlpage.parse_full]:
+      t, tree = timed(lambda: [parse(text) for i in range(args.repeat)][-1])
+      times.append(t / args.repeat)
+      forms.append(dict((form.get('name'), HTMLForm(form).to_params())
+                        for form in tree.iter('{' + htmlpage.XHTML_NAMESPACE + '}form')))
+    same = 'same forms' if forms[0] == forms[1] else 'FORMS DIFFER, html5lib fallback needed'
+    print '{}: lxml {:.1f} ms, html5lib {:.1f} ms ({:.0f}x), {}'.format(
+      os.path.basename(path), times[0] * 1000, times[1] * 1000, times[1] / times[0], same)
+
+def serve_directory(directory):
+  """Spusti HTTP server nad adresarom na nahodnom porte, vrati base URL"""
+  import SimpleHTTPServer
+  import SocketServer
+  class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    def translate_path(self, path):
+      return os.path.join(directory, os.path.basename(path.split('?', 1)[0]))
+    def log_message(self, *args):
+      pass
+  server = SocketServer.TCPServer(('127.0.0.1', 0), Handler)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return 'http://127.0.0.1:{}/'.format(server.server_address[1])
+
+def bench_wsdl(args):
+  """Porovna vytvaranie suds klienta pre kazde spojenie s SudsClientPool,
+     WSDL (a importovane schemy) sa servuju lokalne z adresara suboru --wsdl
+  """
+  import tempfile
+  import shutil
+  from suds.client import Client
+  from wok import SudsClientPool
+  base = serve_directory(os.path.dirname(os.path.abspath(args.wsdl)))
+  url = base + os.path.basename(args.wsdl)
+  cache_dir = tempfile.mkdtemp()
+  try:
+    def fresh():
+      for i in range(args.count):
+        Client(url, cache=None, headers={'Cookie': 'SID=session{}'.format(i)})
+    def pooled():
+      pool = SudsClientPool(cache_dir=cache_dir)
+      for i in range(args.count):
+        pool.client(url, 'session{}'.format(i))
+    for name, fn in [('fresh Client', fresh), ('SudsClientPool', pooled)]:
+      t, _ = timed(fn)
+      print '{:15} {} connections in {:.3f}s ({:.2f} ms/connection)'.format(name, args.count, t, t * 1000 / args.count)
+  finally:
+    shutil.rmtree(cache_dir)
+
+if __name__ == '__main__':
+  import argparse
+  
+  parser = argparse.ArgumentParser()
+  subparsers = parser.add_subparsers()
+  
+  parser_merge = subparsers.add_parser('merge')
+  parser_merge.add_argument('--count', type=int, default=10000)
+  parser_merge.add_argument('--no-reference', dest='reference', action='store_false', help='do not run the quadratic algorithm')
+  parser_merge.set_defaults(func=bench_merge)
+  
+  parser_memory = subparsers.add_parser('memory')
+  parser_memory.add_argument('--count', type=int, default=100000)
+  parser_memory.set_defaults(func=bench_memory)
+  
+  parser_codec = subparsers.add_parser('codec')
+  parser_codec.add_argument('--count', type=int, default=10000)
+  parser_codec.set_defaults(func=bench_codec)
+  
+  parser_throttle = subparsers.add_parser('throttle')
+  parser_throttle.add_argument('--threads', type=int, default=16)
+  parser_throttle.add_argument('--requests', type=int, default=1000, help='requests per thread')
+  parser_throttle.add_argument('--number', type=int, default=10000)
+  parser_throttle.add_argument('--period', type=float, default=10)
+  parser_throttle.add_argument('--step', type=float, default=0.0001, help='fake clock advance per reading')
+  parser_throttle.set_defaults(func=bench_throttle)
+  
+  parser_html = subparsers.add_parser('html')
+  parser_html.add_argument('pages', nargs='+', help='saved HTML pages')
+  parser_html.add_argument('--repeat', type=int, default=5)
+  parser_html.set_defaults(func=bench_html)
+  
+  parser_wsdl = subparsers.add_parser('wsdl')
+  parser_wsdl.add_argument('wsdl', help='local copy of a WSDL file, e.g. WokSearchLite.wsdl')
+  parser_wsdl.add_argument('--count', type=int, default=50)
+  parser_wsdl.set_defaults(func=bench_wsdl)
+  
+  args = parser.parse_args()
+  
+  args.func(args)
@@ -99,6 +99,27 @@ def delayed(fn):
       return DelayedResult(is_error=True, error=str(e))
   return d
 
+class DelayedBatches(object):
+  """Postupne vracane DelayedResult-y, po preiterovani je v count pocet vysledkov"""
+  def __init__(self, gen):
+    self.gen = gen
+    self.count = 0
+  
+  def __iter__(self):
+    try:
+      for batch in self.gen:
+        if not batch.is_error:
+          self.count += len(batch.result)
+        yield batch
+    except Exception as e:
+      app.logger.exception('Exception in delayed handler, {}'.format(request.url))
+      yield DelayedResult(is_error=True, error=str(e))
+
+def delayed_batches(fn):
+  def d():
+    return DelayedBatches(fn())
+  return d
+
 @app.route('/')
 def index():
   return stream_template('index.html')
@@ -122,18 +143,23 @@ def search_by_author():
   else:
     year = None
   
-  @delayed
+  @delayed_batches
   def get_results():
+    # vysledky posielame po zdrojoch hned ako pridu, uplne zoradenie spravi klient
     with config.data_source() as conn:
-      results = list(conn.search_by_author(surname, name=name, year=year))
-    
-    results.sort(key=lambda r: r.title.lower())
-    results.sort(key=lambda r: r.year)
-    
-    for result in results:
-      result.serialized = serializer.dumps(result.to_dict())
-    
-    return results
+      for source_result in conn.search_by_author_batches(surname, name=name, year=year):
+        if source_result.is_error:
+          yield DelayedResult(is_error=True, error='{}: {}'.format(source_result.name, source_result.error))
+          continue
+        
+        results = source_result.result
+        results.sort(key=lambda r: r.title.lower())
+        results.sort(key=lambda r: r.year)
+        
+        for result in results:
+          result.serialized = serializer.dumps(result.to_dict())
+        
+        yield DelayedResult(result=results)
   
   return stream_template('search-by-author.html',
     search_name=name, search_surname=surname, search_year=year,
@@ -190,6 +216,18 @@ def search_citations():
   
   return stream_template('search-citations.html', query_pubs=pubs, get_results=get_results)
 
+def iter_data_sources(ds):
+  """Prejde vsetky data sources vratane tych obalenych v Merge, cache a Wok"""
+  yield ds
+  subs = list(getattr(ds, 'data_sources', ()))
+  for attr in ('real', 'ws', 'web', 'lamr', 'auth'):
+    sub = getattr(ds, attr, None)
+    if sub is not None:
+      subs.append(sub)
+  for sub in subs:
+    for x in iter_data_sources(sub):
+      yield x
+
 @app.route('/admin/')
 def admin_status():
   r = config.redis
@@ -212,7 +250,22 @@ def admin_status():
     pipe.zrevrange('citacie:log:request:{}'.format(key), 0, 25, withscores=True)
   results = pipe.execute()
   
-  return render_template('admin-status.html', status=status, results=zip(request_keys, results))
+  caches = OrderedDict()
+  caches['util.normalize'] = util.normalize.cache.info()
+  for ds in iter_data_sources(config.data_source):
+    if getattr(ds, 'local', None) is not None:
+      caches['L1 {}'.format(ds.key)] = ds.local.info()
+    if getattr(ds, 'sessions', None) is not None:
+      caches['sessions {}'.format(type(ds).__name__)] = ds.sessions.info()
+  
+  throttlers = OrderedDict()
+  for ds in iter_data_sources(config.data_source):
+    throttler = getattr(ds, 'throttler', None)
+    if throttler is not None and id(throttler) not in throttlers:
+      throttlers[id(throttler)] = (type(ds).__name__, throttler.info())
+  
+  return render_template('admin-status.html', status=status, results=zip(request_keys, results), caches=caches,
+                         throttlers=throttlers.values())
 
 def admin_request_by_key(key):
   r = config.redis
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Serializacia zoznamov publikacii pre cache
+
+Novy format zacina hlavickou MAGIC + kodek + verzia schemy + kompresia,
+vsetko ostatne (hlavne stare JSON zaznamy) sa cita ako JSON.
+"""
+from model import Publication
+import json
+import marshal
+import zlib
+import logging
+
+logger = logging.getLogger('citacie.codec')
+
+try:
+  import lz4.frame as lz4
+except ImportError:
+  lz4 = None
+
+MAGIC = '\x00'
+
+class UnknownFormat(ValueError):
+  """Data v cache su v nepodporovanom formate"""
+
+COMPRESSIONS = {
+  'n': (lambda s: s, lambda s: s),
+  'z': (lambda s: zlib.compress(s, 6), zlib.decompress),
+}
+if lz4 is not None:
+  COMPRESSIONS['l'] = (lz4.compress, lz4.decompress)
+
+COMPRESSION_NAMES = {None: 'n', 'zlib': 'z', 'lz4': 'l'}
+
+class JSONCodec(object):
+  """Povodny format, json zoznam Publication.to_dict()"""
+  def dumps(self, pubs):
+    return json.dumps([pub.to_dict() for pub in pubs], sort_keys=True)
+  
+  def loads(self, s):
+    return load_publications(s)
+
+class MarshalCodec(object):
+  """Zoznam Publication.to_tuple() cez marshal, volitelne komprimovany"""
+  codec_id = 'M'
+  schema_version = '1'
+  
+  def __init__(self, compression='zlib'):
+    if compression not in COMPRESSION_NAMES:
+      raise ValueError('Unknown compression {!r}'.format(compression))
+    self.compression = COMPRESSION_NAMES[compression]
+    if self.compression not in COMPRESSIONS:
+      raise ValueError('Compression {!r} is not available'.format(compression))
+  
+  def dumps(self, pubs):
+    compress = COMPRESSIONS[self.compression][0]
+    payload = marshal.dumps(tuple(pub.to_tuple() for pub in pubs), 2)
+    return MAGIC + self.codec_id + self.schema_version + self.compression + compress(payload)
+  
+  def loads(self, s):
+    return load_publications(s)
+
+def load_publications(s):
+  """Nacita zoznam publikacii v lubovolnom podporovanom formate"""
+  if not s.startswith(MAGIC):
+    return [Publication.from_dict(d) for d in json.loads(s)]
+  header, payload = s[:4], s[4:]
+  codec_id, schema_version, compression = header[1:]
+  if codec_id != MarshalCodec.codec_id or schema_version != MarshalCodec.schema_version:
+    raise UnknownFormat('Unknown cache format {!r}'.format(header))
+  if compression not in COMPRESSIONS:
+    raise UnknownFormat('Unsupported compression {!r}'.format(compression))
+  decompress = COMPRESSIONS[compression][1]
+  return [Publication.from_tuple(t) for t in marshal.loads(decompress(payload))]
+
+# chyby, ktore znamenaju poskodene data alebo format z inej verzie
+DECODE_ERRORS = (ValueError, EOFError, TypeError, IndexError, zlib.error)
+
+def loads_or_none(codec, s):
+  """Dekoduje hodnotu z cache, ak sa neda precitat (neznama verzia schemy,
+     poskodene data), zaloguje to a vrati None, volajuci ju ma brat ako miss
+  """
+  try:
+    return codec.loads(s)
+  except DECODE_ERRORS:
+    logger.warning('Cannot decode cached value %r...', s[:8], exc_info=True)
+    return None
@@ -1,6 +1,48 @@
 # -*- coding: utf-8 -*-
 from abc import ABCMeta, abstractmethod
 
+def source_name(data_source):
+  return getattr(data_source, 'key', None) or type(data_source).__name__
+
+def citations_by_publication(keys, found):
+  """Vysledok search_citations_by_publication. keys su kluce publikacii v ich
+     poradi (None, ak ju zdroj nevie vyhladat), found kluc -> zoznam citacii.
+  """
+  results = []
+  returned = set()
+  for key in keys:
+    if key is None:
+      results.append(None)
+    elif key in returned:
+      # volajuci publikacie upravuju, rovnaka publikacia dostane kopie
+      results.append([pub.copy() for pub in found[key]])
+    else:
+      returned.add(key)
+      results.append(found[key])
+  return results
+
+class SourceResult(object):
+  """Vysledok (alebo chyba) jedneho zdroja dat"""
+  def __init__(self, data_source, result=None, exc_info=None):
+    self.data_source = data_source
+    self.result = result
+    self.exc_info = exc_info
+  
+  @property
+  def name(self):
+    return source_name(self.data_source)
+  
+  @property
+  def is_error(self):
+    return self.exc_info is not None
+  
+  @property
+  def error(self):
+    return self.exc_info[1]
+  
+  def reraise(self):
+    raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
 class DataSource(object):
   __metaclass__ = ABCMeta
   
@@ -27,6 +69,12 @@ class DataSourceConnection(object):
     """
     raise NotImplemented
   
+  def search_by_author_batches(self, surname, name=None, year=None):
+    """Ako search_by_author, ale vracia iterator SourceResult objektov postupne,
+       ako su jednotlive casti vysledkov k dispozicii (napr. po zdrojoch)
+    """
+    yield SourceResult(self, result=list(self.search_by_author(surname, name=name, year=year)))
+  
   @abstractmethod
   def search_citations(self, publications):
     """Vrati iterator vracajuci zoznam publikacii, ktore cituju publikacie
@@ -34,6 +82,27 @@ class DataSourceConnection(object):
     """
     raise NotImplemented
   
+  def can_search_citations(self, publication):
+    """Ci ma publikacia vsetko, co zdroj potrebuje na hladanie jej citacii
+       (identifikator, odkaz na citacie, ...)
+    """
+    return True
+  
+  def search_citations_by_publication(self, publications):
+    """Ako search_citations, ale vrati zoznam citacii pre kazdu publikaciu
+       zvlast v poradi publications. Pre publikacie, ktore zdroj nevie
+       vyhladat (can_search_citations), vrati None namiesto zoznamu.
+       Zdroje, ktore vedia citacie viacerych publikacii hladat naraz, to
+       maju prepisat, default sa pyta na kazdu publikaciu samostatne.
+    """
+    results = []
+    for publication in publications:
+      if self.can_search_citations(publication):
+        results.append(list(self.search_citations([publication])))
+      else:
+        results.append(None)
+    return results
+  
   @abstractmethod
   def assign_indexes(self, publications):
     """Zisti a nastavi, v akych indexoch sa publikacie nachadzaju
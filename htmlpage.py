@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import html5lib
+import lxml.etree
+import logging
+
+logger = logging.getLogger('citacie.htmlpage')
+
+XHTML_NAMESPACE = 'http://www.w3.org/1999/xhtml'
+namespaces = {'html': XHTML_NAMESPACE}
+
+def parse_fast(text):
+  """Sparsuje HTML cez libxml2 a elementy presunie do XHTML namespace,
+     aby sa strom dal pouzivat rovnako ako strom z html5lib (treebuilder lxml).
+     Vrati None, ak sa dokument sparsovat nepodari.
+  """
+  if isinstance(text, unicode):
+    text = text.encode('UTF-8')
+  try:
+    root = lxml.etree.fromstring(text, lxml.etree.HTMLParser(encoding='UTF-8'))
+  except (lxml.etree.ParserError, lxml.etree.XMLSyntaxError, ValueError):
+    return None
+  if root is None:
+    return None
+  prefix = '{' + XHTML_NAMESPACE + '}'
+  for elem in root.iter():
+    # komentare a processing instructions maju ako tag funkciu
+    if isinstance(elem.tag, basestring):
+      elem.tag = prefix + elem.tag
+  return root.getroottree()
+
+def parse_full(text):
+  return html5lib.parse(text, treebuilder='lxml')
+
+class HTMLPage(object):
+  """Odpoved servera sparsovana najviac raz kazdym parserom.
+     Najprv sa pouzije rychly lxml, pomaly html5lib az ked lxml nieco nenajde.
+     libxml2 vsak niekedy postavi strom inak a najde nieco ine (napr. formulare
+     v tabulkach maju v lxml inputy, v html5lib su prazdne), preto vsetko, co
+     zavisi od struktury formularov, treba hladat s exact=True len v html5lib.
+  """
+  def __init__(self, response):
+    self.url = response.url
+    self.text = response.text
+    self._fast = None
+    self._fast_parsed = False
+    self._full = None
+  
+  @property
+  def fast_tree(self):
+    if not self._fast_parsed:
+      self._fast = parse_fast(self.text)
+      self._fast_parsed = True
+    return self._fast
+  
+  @property
+  def full_tree(self):
+    if self._full == None:
+      logger.debug('Parsing %s with html5lib', self.url)
+      self._full = parse_full(self.text)
+    return self._full
+  
+  def _trees(self, exact=False):
+    if not exact and self.fast_tree is not None:
+      yield self.fast_tree
+    yield self.full_tree
+  
+  def find(self, path, exact=False):
+    """Prvy element podla ElementTree path alebo None.
+       exact - hladat len v strome z html5lib (napr. formulare, ktore sa posielaju)
+    """
+    for tree in self._trees(exact):
+      elem = tree.find(path)
+      if elem is not None:
+        return elem
+    return None
+  
+  def xpath(self, expr, required=False, exact=False):
+    """Vysledok XPath s prefixom html: pre XHTML namespace.
+       Prazdny vysledok sa skusa v html5lib strome len ak required=True.
+       exact - hladat len v strome z html5lib
+    """
+    result = []
+    for tree in self._trees(exact):
+      result = tree.xpath(expr, namespaces=namespaces)
+      if result or not required:
+        return result
+    return result
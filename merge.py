@@ -1,82 +1,215 @@
 # -*- coding: utf-8 -*-
-from data_source import DataSource, DataSourceConnection
+from data_source import DataSource, DataSourceConnection, SourceResult, source_name
 from model import Publication
+import Queue
+import threading
+import logging
+import time
+import sys
+
+logger = logging.getLogger('citacie.merge')
+
+def blocking_key(pub):
+  """Kluc, v ktorom sa musia zhodovat vsetky publikacie, ktore su si rovne
+     (Publication.__eq__ vyzaduje rovnaky rok aj normalizovany nazov)
+  """
+  return (pub.year, pub.norm_title)
+
+def find_duplicates(publications):
+  """Rozdeli publikacie na skupiny duplikatov, vysledok je zoznam zoznamov
+  
+     Ekvivalentne s tym, ze zakazdym vyberieme prvu nespracovanu publikaciu
+     a k nej vsetky zvysne, ktore sa jej rovnaju (od konca zoznamu), ale
+     uplne porovnanie robime len v ramci rovnakeho blocking_key
+  """
+  blocks = {}
+  for i, pub in enumerate(publications):
+    blocks.setdefault(blocking_key(pub), []).append(i)
+  
+  consumed = [False] * len(publications)
+  buckets = []
+  for i, cur in enumerate(publications):
+    if consumed[i]:
+      continue
+    key = blocking_key(cur)
+    # vsetko pred i je uz spracovane, takze i je prve v bloku
+    rest = blocks[key][1:]
+    bucket = [cur]
+    remaining = []
+    for j in reversed(rest):
+      if publications[j] == cur:
+        bucket.append(publications[j])
+        consumed[j] = True
+      else:
+        remaining.append(j)
+    remaining.reverse()
+    blocks[key] = remaining
+    buckets.append(bucket)
+  return buckets
+
+def merge_bucket(bucket):
+  """Spoji skupinu duplikatov do jednej publikacie"""
+  cur = bucket[0]
+  def find_longest(attr):
+    longest = None
+    for p in bucket:
+      v = getattr(p, attr)
+      if v != None:
+        if longest == None:
+          longest = (p, v)
+        elif len(v) > len(longest):
+          longest = (p, v)
+    if longest == None:
+      return (None, None)
+    return longest
+  lauthors_pub, lauthors = find_longest('authors')
+  mpub = Publication(find_longest('title')[1], lauthors, cur.year)
+  mpub.authors_incomplete = lauthors_pub.authors_incomplete
+  mpub.published_in = find_longest('published_in')[1]
+  mpub.pages = find_longest('pages')[1]
+  mpub.volume = find_longest('volume')[1]
+  mpub.series = find_longest('series')[1]
+  mpub.issue = find_longest('issue')[1]
+  mpub.special_issue = find_longest('special_issue')[1]
+  mpub.supplement = find_longest('supplement')[1]
+  mpub.times_cited = max(p.times_cited for p in bucket)
+  mpub.article_no = find_longest('article_no')[1]
+  mpub.publisher = find_longest('publisher')[1]
+  mpub.publisher_city = find_longest('publisher_city')[1]
+  mpub.edition = find_longest('edition')[1]
+  mpub.source_urls = list(set([x for p in bucket for x in p.source_urls]))
+  mpub.cite_urls = list(set([x for p in bucket for x in p.cite_urls]))
+  mpub.identifiers = list(set([x for p in bucket for x in p.identifiers]))
+  mpub.indexes = list(set([x for p in bucket for x in p.indexes]))
+  mpub.merge_sources = bucket
+  return mpub
 
 class Merge(DataSource):
-  def __init__(self, *data_sources):
+  def __init__(self, *data_sources, **kwargs):
+    """
+    concurrent - ci sa maju zdroje dotazovat naraz, kazdy vo vlastnom threade
+    timeout - kolko maximalne cakat na jeden zdroj (v sekundach), None = bez limitu
+    """
     self.data_sources = data_sources
+    self.concurrent = kwargs.pop('concurrent', True)
+    self.timeout = kwargs.pop('timeout', None)
+    if kwargs:
+      raise TypeError('Unexpected keyword arguments: {}'.format(', '.join(kwargs)))
     
   def connect(self):
-    return MergeConnection(self.data_sources)
-  
+    return MergeConnection(self.data_sources, concurrent=self.concurrent, timeout=self.timeout)
+
+class SourceTimeout(Exception):
+  """Zdroj nevratil vysledok v zadanom case"""
+
 class MergeConnection(DataSourceConnection):
-  def __init__(self, data_sources):
+  def __init__(self, data_sources, concurrent=True, timeout=None):
     self.data_sources = data_sources
+    self.concurrent = concurrent
+    self.timeout = timeout
   
-  def search_by_author(self, surname, name=None, year=None):
-    for data_source in self.data_sources: # TODO move to connection setup to __enter__
+  def _call(self, data_source, fn):
+    try:
       with data_source() as conn:
-        for pub in conn.search_by_author(surname, name=name, year=year):
-          yield pub
+        return SourceResult(data_source, result=fn(conn))
+    except Exception:
+      logger.exception('Data source %s failed', source_name(data_source))
+      return SourceResult(data_source, exc_info=sys.exc_info())
+  
+  def _fan_out(self, fn):
+    """Zavola fn(conn) pre kazdy data source a vracia SourceResult-y v poradi,
+       v akom zdroje skoncili. fn musi vysledok materializovat (nie generator),
+       lebo connection sa po navrate zatvara.
+    """
+    if not self.concurrent:
+      for data_source in self.data_sources: # TODO move to connection setup to __enter__
+        yield self._call(data_source, fn)
+      return
+    
+    results = Queue.Queue()
+    for data_source in self.data_sources:
+      worker = threading.Thread(target=lambda ds=data_source: results.put(self._call(ds, fn)),
+                                name='merge-{}'.format(source_name(data_source)))
+      # ak zdroj nestihne timeout, nechame ho dobehnut na pozadi
+      worker.daemon = True
+      worker.start()
+    
+    if self.timeout is not None:
+      deadline = time.time() + self.timeout
+    pending = set(self.data_sources)
+    while pending:
+      try:
+        if self.timeout is None:
+          # bez timeoutu by get() nereagoval na KeyboardInterrupt
+          res = results.get(True, 365 * 24 * 60 * 60)
+        else:
+          res = results.get(True, max(0, deadline - time.time()))
+      except Queue.Empty:
+        break
+      pending.discard(res.data_source)
+      yield res
+    
+    for data_source in self.data_sources:
+      if data_source not in pending:
+        continue
+      logger.warning('Data source %s timed out after %ss', source_name(data_source), self.timeout)
+      try:
+        raise SourceTimeout('timed out after {}s'.format(self.timeout))
+      except SourceTimeout:
+        yield SourceResult(data_source, exc_info=sys.exc_info())
+  
+  def _collect(self, fn):
+    """Vrati (vysledky uspesnych zdrojov, chybove SourceResult-y), ak zlyhali
+       vsetky zdroje, vyhodi prvu chybu
+    """
+    ok = []
+    failed = []
+    for res in self._fan_out(fn):
+      if res.is_error:
+        failed.append(res)
+      else:
+        ok.append(res)
+    # vysledky skladame v poradi zdrojov, nie v poradi dokoncenia
+    order = dict((ds, i) for i, ds in enumerate(self.data_sources))
+    ok.sort(key=lambda r: order[r.data_source])
+    if failed and not ok:
+      failed[0].reraise()
+    return [r.result for r in ok], failed
+  
+  def _report_failures(self, publications, failed, message):
+    """Prida chyby zlyhanych zdrojov k publikaciam, ak nie je ku comu,
+       vyhodi prvu chybu, aby sa neukazalo len prazdne hladanie
+    """
+    if failed and not publications:
+      failed[0].reraise()
+    for res in failed:
+      error = message.format(name=res.name, error=res.error)
+      for pub in publications:
+        pub.errors.append(error)
+  
+  def search_by_author(self, surname, name=None, year=None):
+    results, failed = self._collect(lambda conn: list(conn.search_by_author(surname, name=name, year=year)))
+    pubs = [pub for result in results for pub in result]
+    self._report_failures(pubs, failed, u'Results from {name} are missing: {error}')
+    return pubs
+  
+  def search_by_author_batches(self, surname, name=None, year=None):
+    return self._fan_out(lambda conn: list(conn.search_by_author(surname, name=name, year=year)))
   
   def search_citations(self, publications):
-    cit = []
-    for data_source in self.data_sources: # TODO move to connection setup to __enter__
-      with data_source() as conn:
-        cit.extend(list(conn.search_citations(publications)))
+    results, failed = self._collect(lambda conn: list(conn.search_citations(publications)))
+    cit = [pub for result in results for pub in result]
     
     cit.sort(key=lambda r: r.title)
     cit.sort(key=lambda r: r.year)
     
-    merged = []
-    
-    while len(cit) > 0:
-      cur = cit.pop(0)
-      bucket = [cur]
-      for i in xrange(len(cit) - 1, -1, -1):
-        if cit[i] == cur:
-          bucket.append(cit[i])
-          del cit[i]
-      def find_longest(attr):
-        longest = None
-        for p in bucket:
-          v = getattr(p, attr)
-          if v != None:
-            if longest == None:
-              longest = (p, v)
-            elif len(v) > len(longest):
-              longest = (p, v)
-        if longest == None:
-          return (None, None)
-        return longest
-      lauthors_pub, lauthors = find_longest('authors')
-      mpub = Publication(find_longest('title')[1], lauthors, cur.year)
-      mpub.authors_incomplete = lauthors_pub.authors_incomplete
-      mpub.published_in = find_longest('published_in')[1]
-      mpub.pages = find_longest('pages')[1]
-      mpub.volume = find_longest('volume')[1]
-      mpub.series = find_longest('series')[1]
-      mpub.issue = find_longest('issue')[1]
-      mpub.special_issue = find_longest('special_issue')[1]
-      mpub.supplement = find_longest('supplement')[1]
-      mpub.times_cited = max(p.times_cited for p in bucket)
-      mpub.article_no = find_longest('article_no')[1]
-      mpub.publisher = find_longest('publisher')[1]
-      mpub.publisher_city = find_longest('publisher_city')[1]
-      mpub.edition = find_longest('edition')[1]
-      mpub.source_urls = list(set([x for p in bucket for x in p.source_urls]))
-      mpub.cite_urls = list(set([x for p in bucket for x in p.cite_urls]))
-      mpub.identifiers = list(set([x for p in bucket for x in p.identifiers]))
-      mpub.indexes = list(set([x for p in bucket for x in p.indexes]))
-      mpub.merge_sources = bucket
-      merged.append(mpub)
-    
+    merged = [merge_bucket(bucket) for bucket in find_duplicates(cit)]
+    self._report_failures(merged, failed, u'Citations from {name} are missing: {error}')
     return merged
   
   def assign_indexes(self, publications):
-    for data_source in self.data_sources: # TODO move to connection setup to __enter__
-      with data_source() as conn:
-        conn.assign_indexes(publications)
+    results, failed = self._collect(lambda conn: conn.assign_indexes(publications))
+    self._report_failures(publications, failed, u'Indexes from {name} were not assigned: {error}')
   
   def close(self):
-    pass # TODO close connections created in __enter__
\ No newline at end of file
+    pass # TODO close connections created in __enter__
@@ -2,7 +2,7 @@
 import types
 import re
 from itertools import izip_longest
-from util import normalize
+from util import normalize, LRUCache
 
 def is_initial(name):
   if name.endswith('.'):
@@ -13,7 +13,43 @@ def is_initial(name):
     return True
   return False
 
-class Author(object):
+# internuju sa len kratke hodnoty, dlhsi volny text (popisy) sa neopakuje
+INTERN_MAX_LENGTH = 64
+_interned = LRUCache(1024)
+
+def intern_value(value):
+  """Zdiela rovnake hodnoty z malej mnoziny (typy identifikatorov, indexy, ...)
+     medzi vsetkymi objektmi, vstavany intern() v pythone 2 nevie unicode.
+     Cache je ohranicena, aby v dlho beziacom procese nerastla.
+  """
+  if value is None or len(value) > INTERN_MAX_LENGTH:
+    return value
+  interned = _interned.get(value)
+  if interned is None:
+    _interned.put(value, value)
+    interned = value
+  return interned
+
+class Normalized(object):
+  """Mixin, ktory cachuje normalizovane hodnoty atributov kym sa nezmenia"""
+  __slots__ = ()
+  
+  def _normalized(self, attr):
+    value = getattr(self, attr)
+    try:
+      cache = self._normalized_cache
+    except AttributeError:
+      cache = self._normalized_cache = {}
+    cached = cache.get(attr)
+    if cached is not None and cached[0] == value:
+      return cached[1]
+    norm = normalize(value)
+    cache[attr] = (value, norm)
+    return norm
+
+class Author(Normalized):
+  __slots__ = ('surname', 'names', 'unparsed_text', '_normalized_cache')
+  
   def __init__(self, surname, names=None, unparsed_text=None):
     if not isinstance(surname, types.StringTypes):
       raise TypeError('surname must be string')
@@ -49,23 +85,54 @@ class Author(object):
   def from_dict(cls, d):
     return cls(d['surname'], names=d['names'], unparsed_text=d.get('unparsed_text'))
   
+  def to_tuple(self):
+    return (self.surname, tuple(self.names), self.unparsed_text)
+  
+  @classmethod
+  def from_tuple(cls, t):
+    return cls(t[0], names=t[1], unparsed_text=t[2])
+  
+  @property
+  def norm_surname(self):
+    return self._normalized('surname')
+  
+  @property
+  def first_name(self):
+    if len(self.names) == 0:
+      return None
+    return self.names[0]
+  
+  @property
+  def norm_first_name(self):
+    return self._normalized('first_name')
+  
+  @property
+  def first_initial(self):
+    if len(self.names) == 0:
+      return None
+    return self.names[0][0]
+  
+  @property
+  def norm_first_initial(self):
+    return self._normalized('first_initial')
+  
   def __eq__(self, other):
     if not isinstance(other, Author):
       return NotImplemented
-    if normalize(self.surname) != normalize(other.surname):
+    if self.norm_surname != other.norm_surname:
       return False
     if len(self.names) > 0 and len(other.names) > 0:
       if is_initial(self.names[0]) or is_initial(other.names[0]):
-        return normalize(self.names[0][0]) == normalize(other.names[0][0])
+        return self.norm_first_initial == other.norm_first_initial
       else:
-        return normalize(self.names[0]) == normalize(other.names[0])
+        return self.norm_first_name == other.norm_first_name
     return True
   
   def __hash__(self):
     """Hash musi zavisiet len na priezvisku, lebo to v niektorych pripadoch staci na to,
        aby sa dva Author objekty rovnali
     """
-    return hash(normalize(self.surname))
+    return hash(self.norm_surname)
   
   @property
   def formatted_surname(self):
@@ -143,6 +210,8 @@ class Author(object):
     return [cls.parse_sn_first(x.strip()) for x in names.split(separator)]
 
 class TaggedValue(object):
+  __slots__ = ('value', 'type', 'description')
+  
   def __init__(self, value, type=None, description=None):
     """Reprezentuje hodnotu s typom
     
@@ -152,8 +221,8 @@ class TaggedValue(object):
       verzie, da sa to popisat v tejto poznamke
     """
     self.value = value
-    self.type = type
-    self.description = description
+    self.type = intern_value(type)
+    self.description = intern_value(description)
   
   def __unicode__(self):
     r = u''
@@ -189,6 +258,13 @@ class TaggedValue(object):
   def from_dict(cls, d):
     return cls(d['value'], type=d['type'], description=d['description'])
   
+  def to_tuple(self):
+    return (self.value, self.type, self.description)
+  
+  @classmethod
+  def from_tuple(cls, t):
+    return cls(t[0], type=t[1], description=t[2])
+  
   @staticmethod
   def find_by_type(iterable, type):
     return filter(lambda x: x.type == type, iterable)
@@ -201,15 +277,29 @@ class Identifier(TaggedValue):
   description = pridany popis identifikatora, napriklad ak je viac roznych ISBN pre hardcover a paperback 
     verzie, da sa to popisat v tejto poznamke
   """
-  pass
+  __slots__ = ()
 
 class URL(TaggedValue):
-  pass
+  __slots__ = ()
 
 class Index(TaggedValue):
-  pass
+  __slots__ = ()
+  
+  def __init__(self, value, type=None, description=None):
+    super(Index, self).__init__(intern_value(value), type=type, description=description)
 
-class Publication(object):
+class Publication(Normalized):
+  __slots__ = ('title', 'authors', 'authors_incomplete', 'year', 'published_in', 'pages',
+               'volume', 'series', 'issue', 'special_issue', 'supplement', 'times_cited',
+               'article_no', 'publisher', 'publisher_city', 'edition', 'source_urls',
+               'cite_urls', 'identifiers', 'indexes', 'errors', '_normalized_cache',
+               # nastavuju merge a citacie pri zobrazovani
+               'merge_sources', 'serialized', 'autocit')
+  _list_attrs = ('authors', 'source_urls', 'cite_urls', 'identifiers', 'indexes', 'errors')
+  _data_attrs = ('title', 'authors_incomplete', 'year', 'published_in', 'pages', 'volume',
+                 'series', 'issue', 'special_issue', 'supplement', 'times_cited', 'article_no',
+                 'publisher', 'publisher_city', 'edition')
+  
   def __init__(self, title, authors, year, published_in=None, pages=None, volume=None, series=None, issue=None, special_issue=None, supplement=None, source_urls=None, cite_urls=None, identifiers=None, errors=None, authors_incomplete=False, indexes=None, times_cited=None, article_no=None, publisher=None, publisher_city=None, edition=None):
     """Reprezentuje jednu publikaciu
     title = nazov publikacie
@@ -400,22 +490,84 @@ class Publication(object):
       edition=d.get('edition')
     )
   
+  def copy(self):
+    """Kopia, ktoru mozno menit bez vplyvu na povodnu publikaciu
+       (zoznamy su nove, autori a identifikatory sa zdielaju)
+    """
+    pub = Publication.__new__(Publication)
+    for attr in self._data_attrs:
+      setattr(pub, attr, getattr(self, attr))
+    for attr in self._list_attrs:
+      setattr(pub, attr, list(getattr(self, attr)))
+    return pub
+  
+  def to_tuple(self):
+    """Kompaktna reprezentacia pre cache, poradie poli sa nesmie menit
+       bez zmeny verzie formatu v redis_integration
+    """
+    def tuplify(l):
+      return tuple(x.to_tuple() for x in l)
+    return (
+      self.title, tuplify(self.authors), self.year, self.published_in, self.pages,
+      self.volume, self.series, self.issue, self.special_issue, self.supplement,
+      tuplify(self.source_urls), tuplify(self.cite_urls), tuplify(self.identifiers),
+      tuple(self.errors), self.authors_incomplete, tuplify(self.indexes), self.times_cited,
+      self.article_no, self.publisher, self.publisher_city, self.edition
+    )
+  
+  @classmethod
+  def from_tuple(cls, t):
+    return Publication(
+      t[0], [Author.from_tuple(x) for x in t[1]], t[2],
+      published_in=t[3], pages=t[4], volume=t[5], series=t[6], issue=t[7],
+      special_issue=t[8], supplement=t[9], source_urls=[URL.from_tuple(x) for x in t[10]],
+      cite_urls=[URL.from_tuple(x) for x in t[11]],
+      identifiers=[Identifier.from_tuple(x) for x in t[12]],
+      errors=t[13], authors_incomplete=t[14], indexes=[Index.from_tuple(x) for x in t[15]],
+      times_cited=t[16], article_no=t[17], publisher=t[18], publisher_city=t[19],
+      edition=t[20]
+    )
+  
+  @property
+  def norm_title(self):
+    return self._normalized('title')
+  
+  @property
+  def norm_article_no(self):
+    return self._normalized('article_no')
+  
+  @property
+  def norm_pages(self):
+    return self._normalized('pages')
+  
+  @property
+  def norm_volume(self):
+    return self._normalized('volume')
+  
+  @property
+  def norm_issue(self):
+    return self._normalized('issue')
+  
+  @property
+  def norm_published_in(self):
+    return self._normalized('published_in')
+  
   def __eq__(self, other):
     if self.year != other.year:
       return False
     if not self.authors_incomplete and not other.authors_incomplete and self.authors != other.authors:
       return False
-    if normalize(self.title) != normalize(other.title):
+    if self.norm_title != other.norm_title:
       return False
-    if normalize(self.article_no) != normalize(other.article_no):
+    if self.norm_article_no != other.norm_article_no:
       return False
-    if normalize(self.pages) != normalize(other.pages):
+    if self.norm_pages != other.norm_pages:
       return False
-    if normalize(self.volume) != normalize(other.volume):
+    if self.norm_volume != other.norm_volume:
       return False
-    if normalize(self.issue) != normalize(other.issue):
+    if self.norm_issue != other.norm_issue:
       return False
-    if normalize(self.published_in) != normalize(other.published_in):
+    if self.norm_published_in != other.norm_published_in:
       return False
     return True
   
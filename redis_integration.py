@@ -2,44 +2,157 @@
 from data_source import DataSource, DataSourceConnection
 from wok import WokWS, WokWSConnection, WokWeb, WokWebConnection
 from scopus import ScopusWeb, ScopusWebConnection
-from model import Publication
+from model import Identifier
+from codec import MarshalCodec, loads_or_none
 import redis
 import hashlib
 import json
 import retools.lock
 import time
+import threading
+from util import SizedTTLCache
+from throttle import ThrottleTimeout
+from collections import OrderedDict
+import logging
+
+logger = logging.getLogger('citacie.redis')
 
 serializer = json
 
 def dumps(arg):
   return serializer.dumps(arg, sort_keys=True)
 
-def loads(arg):
-  return serializer.loads(arg)
-
 def hash_key(*args):
   s = dumps(args)
   return hashlib.sha1(s).hexdigest()
 
+def publication_key(pub):
+  """Kluc publikacie pre cache citacii, podla identifikatora ak nejaky ma"""
+  for typ in ('WOK', 'SCOPUS', 'DOI'):
+    ids = Identifier.find_by_type(pub.identifiers, typ)
+    if len(ids) > 0:
+      return hash_key(typ, ids[0].value)
+  # bez identifikatora, meniace sa polia (pocet citacii, ...) do kluca nedavame
+  d = pub.to_dict()
+  for volatile in ('times_cited', 'errors', 'indexes', 'cite_urls', 'source_urls'):
+    del d[volatile]
+  return hash_key(d)
+
+class LocalCache(object):
+  """Cache dekodovanych hodnot v pamati procesu pred redisom (L1)
+  
+     Polozky platia najviac ttl sekund a kym sa nezmeni generacia namespace
+     v redise, tu kontrolujeme najviac raz za stamp_interval sekund.
+     max_bytes sa pocita z dlzky zakodovanych hodnot, ako su ulozene v redise.
+  """
+  def __init__(self, max_bytes=32*1024*1024, ttl=60, stamp_interval=5):
+    self.cache = SizedTTLCache(max_bytes, ttl)
+    self.stamp_interval = stamp_interval
+    self._generations = {} # namespace -> (generacia, kedy sme ju zistili)
+    self._lock = threading.Lock()
+  
+  def generation(self, redis, namespace):
+    now = time.time()
+    with self._lock:
+      known = self._generations.get(namespace)
+    if known is not None and known[1] + self.stamp_interval > now:
+      return known[0]
+    gen = redis.get('{}:generation'.format(namespace))
+    with self._lock:
+      self._generations[namespace] = (gen, now)
+    return gen
+  
+  def forget_generation(self, namespace):
+    with self._lock:
+      self._generations.pop(namespace, None)
+  
+  def get(self, redis, namespace, key):
+    entry = self.cache.get((namespace, key))
+    if entry is None:
+      return None
+    gen, value = entry
+    if gen != self.generation(redis, namespace):
+      self.discard(namespace, key)
+      return None
+    return value
+  
+  def discard(self, namespace, key):
+    self.cache.discard((namespace, key))
+  
+  def put(self, redis, namespace, key, value, size):
+    self.cache.put((namespace, key), (self.generation(redis, namespace), value), size)
+  
+  def info(self):
+    return self.cache.info()
+
 class RedisCache(object):
-  def __init__(self, redis, namespace):
+  def __init__(self, redis, namespace, local=None, soft_ttl=60*60, hard_ttl=24*60*60):
     self.redis = redis
     self.namespace = namespace
+    self.local = local
+    self.soft_ttl = soft_ttl
+    self.hard_ttl = hard_ttl
   
   def __getitem__(self, key):
-    return RedisCacheKey(self.redis, self.namespace, key)
+    return RedisCacheKey(self.redis, self.namespace, key, local=self.local,
+                         soft_ttl=self.soft_ttl, hard_ttl=self.hard_ttl)
+  
+  def invalidate(self):
+    """Zneplatni vsetky lokalne (L1) kopie hodnot v tomto namespace vo vsetkych procesoch"""
+    self.redis.incr('{}:generation'.format(self.namespace))
+    if self.local:
+      self.local.forget_generation(self.namespace)
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+# kolko obnovovani na pozadi moze v procese bezat naraz, kazde ma vlastne
+# spojenie so zdrojom; ked su vsetky obsadene, stare hodnoty sa obnovia neskor
+MAX_BACKGROUND_REFRESHES = 2
+_refresh_slots = threading.BoundedSemaphore(MAX_BACKGROUND_REFRESHES)
+
+def run_refresh_in_background(keys, refresh):
+  """Spusti refresh(keys) v samostatnom threade pre kluce, ktore v tomto
+     procese prave nikto neobnovuje. Ak uz bezi MAX_BACKGROUND_REFRESHES
+     obnovovani, nespusti nic.
+  """
+  with _refreshing_lock:
+    keys = [key for key in keys if key.ident not in _refreshing]
+    if not keys:
+      return
+    if not _refresh_slots.acquire(False):
+      logger.debug('Too many background refreshes, postponing %d keys', len(keys))
+      return
+    _refreshing.update(key.ident for key in keys)
+  def run():
+    try:
+      refresh(keys)
+    finally:
+      with _refreshing_lock:
+        _refreshing.difference_update(key.ident for key in keys)
+      _refresh_slots.release()
+  thread = threading.Thread(target=run, name='refresh-{}'.format(keys[0].key))
+  thread.daemon = True
+  thread.start()
 
 class RedisCacheKey(object):
-  def __init__(self, redis, namespace, key):
+  def __init__(self, redis, namespace, key, local=None, soft_ttl=60*60, hard_ttl=24*60*60):
     self.redis = redis
     self.namespace = namespace
     self.key = key
+    self.local = local
+    self.soft_ttl = soft_ttl
+    self.hard_ttl = hard_ttl
     self.namespace_keys = '{}:keys'.format(self.namespace)
     self.misses_key = '{}:misses'.format(self.namespace)
     self.hits_key = '{}:hits'.format(self.namespace)
     self.data_key = '{}:{}:data'.format(self.namespace, self.key)
+    self.fresh_key = '{}:{}:fresh'.format(self.namespace, self.key)
+    self.refresh_key = '{}:{}:refresh'.format(self.namespace, self.key)
+    self.refreshes_key = '{}:refreshes'.format(self.namespace)
+    self.refresh_failures_key = '{}:refresh_failures'.format(self.namespace)
     self.lock_key = '{}:{}:lock'.format(self.namespace, self.key)
     self.locked = False
+    self.stale = False
     self.lock = retools.lock.Lock(self.lock_key, expires=15*60, timeout=3*60, redis=redis)
   
   def _hit(self):
@@ -48,14 +161,23 @@ class RedisCacheKey(object):
   def _missed(self):
     self.redis.incr(self.misses_key)
   
+  def _get(self):
+    pl = self.redis.pipeline()
+    pl.get(self.data_key)
+    pl.exists(self.fresh_key)
+    cached, fresh = pl.execute()
+    self.stale = cached != None and not fresh
+    return cached
+  
   def __enter__(self):
-    # najprv skusime, ci kluc existuje, ak hej, pouzijeme ho
-    cached = self.redis.get(self.data_key)
+    # najprv skusime, ci kluc existuje, ak hej, pouzijeme ho (aj ked je uz
+    # stary, vtedy ho volajuci ma obnovit na pozadi cez refresh_in_background)
+    cached = self._get()
     if cached != None:
       self._hit()
       return cached
     self.lock.acquire()
-    cached = self.redis.get(self.data_key)
+    cached = self._get()
     if cached != None:
       # uz niekto kluc vyrobil za nas
       self.lock.release()
@@ -70,10 +192,91 @@ class RedisCacheKey(object):
       self.lock.release()
     return False
   
-  def store(self, s, expires=60*60):
+  @property
+  def ident(self):
+    return (self.namespace, self.key)
+  
+  def try_lock(self):
+    """Zamkne kluc na obnovenie, ak ho prave neobnovuje (alebo nevyraba)
+       niekto iny. Vrati zamok alebo None.
+    """
+    lock = retools.lock.Lock(self.lock_key, expires=15*60, timeout=0, redis=self.redis)
+    try:
+      lock.acquire()
+    except retools.lock.LockTimeout:
+      logger.debug('%s:%s is already being refreshed', self.namespace, self.key)
+      return None
+    return lock
+  
+  def refresh(self, fetch):
+    """Obnovi hodnotu volanim fetch(), ktory vracia novu zakodovanu hodnotu,
+       ak ju prave neobnovuje (alebo nevyraba) niekto iny. Vrati True ak sa
+       hodnota obnovila.
+    """
+    lock = self.try_lock()
+    if lock is None:
+      return False
+    try:
+      started = time.time()
+      try:
+        s = fetch()
+      # ThrottleTimeout je BaseException, aby ho zdroje nezachytili
+      except (Exception, ThrottleTimeout) as e:
+        logger.exception('Refreshing %s:%s failed', self.namespace, self.key)
+        self._record_refresh(started, 'error', error=str(e))
+        return False
+      self.store(s)
+      self._record_refresh(started, 'ok')
+    finally:
+      lock.release()
+    self.discard_local()
+    return True
+  
+  def _record_refresh(self, started, status, error=''):
+    duration = time.time() - started
+    logger.info('Refreshed %s:%s in %.3fs: %s', self.namespace, self.key, duration, status)
+    pl = self.redis.pipeline()
+    pl.hmset(self.refresh_key, {'started': started, 'duration': duration,
+                                'status': status, 'error': error})
+    pl.incr(self.refreshes_key)
+    if status != 'ok':
+      pl.incr(self.refresh_failures_key)
+    pl.execute()
+  
+  def refresh_in_background(self, fetch):
+    """Spusti refresh(fetch) v samostatnom threade, v jednom procese najviac
+       jeden naraz pre dany kluc
+    """
+    run_refresh_in_background([self], lambda keys: self.refresh(fetch))
+  
+  def get_local(self):
+    """Vrati hodnotu z L1 cache alebo None"""
+    if self.local is None:
+      return None
+    return self.local.get(self.redis, self.namespace, self.key)
+  
+  def discard_local(self):
+    if self.local is not None:
+      self.local.discard(self.namespace, self.key)
+  
+  def store_local(self, value, size):
+    if self.local is not None:
+      self.local.put(self.redis, self.namespace, self.key, value, size)
+  
+  def store(self, s, soft_ttl=None, hard_ttl=None):
+    """soft_ttl - kolko sekund je hodnota cerstva, potom sa este pouziva,
+                  ale obnovuje sa na pozadi
+       hard_ttl - po kolkych sekundach sa hodnota zahodi uplne
+    """
+    if soft_ttl == None:
+      soft_ttl = self.soft_ttl
+    if hard_ttl == None:
+      hard_ttl = max(self.hard_ttl, soft_ttl)
     pl = self.redis.pipeline()
     pl.set(self.data_key, s)
-    pl.expire(self.data_key, expires)
+    pl.expire(self.data_key, hard_ttl)
+    pl.set(self.fresh_key, 1)
+    pl.expire(self.fresh_key, soft_ttl)
     pl.sadd(self.namespace_keys, self.key)
     pl.execute()
 
@@ -84,6 +287,24 @@ class RedisWrappedDataSource(DataSource):
     self.real = real
 
 class RedisCachedDataSource(RedisWrappedDataSource):
+  def __init__(self, redis, key, real, codec=None, local=True, soft_ttl=60*60, hard_ttl=24*60*60):
+    """codec - ako ukladat zoznamy publikacii, default MarshalCodec so zlib,
+               stare JSON zaznamy sa citaju vzdy
+       local - L1 cache v pamati procesu, True = LocalCache() s defaultnymi
+               nastaveniami, None/False = vypnuta
+       soft_ttl - po kolkych sekundach sa hodnota obnovuje na pozadi (stale sa vsak pouziva)
+       hard_ttl - po kolkych sekundach sa hodnota zahodi a dalsi request musi cakat
+    """
+    super(RedisCachedDataSource, self).__init__(redis, key, real)
+    self.soft_ttl = soft_ttl
+    self.hard_ttl = hard_ttl
+    if codec == None:
+      codec = MarshalCodec()
+    self.codec = codec
+    if local is True:
+      local = LocalCache()
+    self.local = local or None
+  
   def connect(self):
     return RedisCachedConnection(self.redis, self, self.real)
   
@@ -92,10 +313,15 @@ class RedisCachedConnection(DataSourceConnection):
     self.redis = redis
     self.ds = ds
     self.real = real
+    self.codec = ds.codec
     self._real_conn = None
     self.namespace = 'citacie:cache:{}'.format(self.ds.key)
-    self.cache_search_by_author = RedisCache(self.redis, '{}:search_by_author'.format(self.namespace))
-    self.cache_search_citations = RedisCache(self.redis, '{}:search_citations'.format(self.namespace))
+    self.cache_search_by_author = self._cache('search_by_author')
+    self.cache_citations = self._cache('citations_by_publication')
+  
+  def _cache(self, method):
+    return RedisCache(self.redis, '{}:{}'.format(self.namespace, method), local=self.ds.local,
+                      soft_ttl=self.ds.soft_ttl, hard_ttl=self.ds.hard_ttl)
   
   @property
   def real_conn(self):
@@ -103,35 +329,147 @@ class RedisCachedConnection(DataSourceConnection):
       self._real_conn = self.real.connect()
     return self._real_conn
   
-  def search_by_author(self, surname, name=None, year=None):
-    key = self.cache_search_by_author[hash_key(surname, name, year)]
+  def _fetch_encoded(self, fetch):
+    """Ziska vysledok vlastnym spojenim, pre obnovovanie na pozadi"""
+    conn = self.real.connect()
+    try:
+      return self.codec.dumps(list(fetch(conn)))
+    finally:
+      conn.close()
+  
+  def _cached(self, key, fetch):
+    """fetch(conn) vracia vysledok zo skutocneho zdroja"""
+    # lokalne kopie sa nesmu dostat von, volajuci publikacie upravuju
+    pubs = key.get_local()
+    if pubs is not None:
+      for pub in pubs:
+        yield pub.copy()
+      return
     with key as cached_value:
       if cached_value != None:
-        parsed_value = loads(cached_value)
-        for pub_dict in parsed_value:
-          yield Publication.from_dict(pub_dict)
-        return
+        pubs = self._decode(key, cached_value, fetch)
+        if pubs is not None:
+          for pub in pubs:
+            yield pub.copy()
+          return
       pubs = []
-      for pub in self.real_conn.search_by_author(surname, name=name, year=year):
+      for pub in fetch(self.real_conn):
         yield pub
         pubs.append(pub)
-      s = dumps([pub.to_dict() for pub in pubs])
-      key.store(s)
+      self._store(key, pubs)
+  
+  def _decode(self, key, cached_value, fetch=None):
+    """Dekoduje hodnotu z redisu a ak je stara a fetch je dany, obnovi ju na
+       pozadi. Data, ktore tato verzia nevie precitat, vrati ako None (miss),
+       prepisu sa novymi.
+    """
+    pubs = loads_or_none(self.codec, cached_value)
+    if pubs is None:
+      return None
+    if key.stale:
+      if fetch is not None:
+        key.refresh_in_background(lambda: self._fetch_encoded(fetch))
+    else:
+      key.store_local(pubs, len(cached_value))
+    return pubs
+  
+  def _store(self, key, pubs):
+    s = self.codec.dumps(pubs)
+    key.store(s)
+    key.store_local(self.codec.loads(s), len(s))
+  
+  def search_by_author(self, surname, name=None, year=None):
+    key = self.cache_search_by_author[hash_key(surname, name, year)]
+    for pub in self._cached(key, lambda conn: conn.search_by_author(surname, name=name, year=year)):
+      yield pub
   
   def search_citations(self, publications):
-    key = self.cache_search_citations[hash_key([[pub.to_dict() for pub in publications]])]
-    with key as cached_value:
-      if cached_value != None:
-        parsed_value = loads(cached_value)
-        for pub_dict in parsed_value:
-          yield Publication.from_dict(pub_dict)
+    # citacie cachujeme po jednotlivych publikaciach, aby sa dali pouzit
+    # aj pre ine kombinacie vybranych publikacii, zo zdroja sa teda pytame
+    # len na tie, ktore v cache nie su, vsetky naraz, aby ich zdroj mohol
+    # hladat v davkach alebo paralelne
+    by_key = OrderedDict()
+    for publication in publications:
+      by_key.setdefault(publication_key(publication), publication)
+    
+    results = {}
+    opened = []
+    stale = []
+    try:
+      # kluce zamykame vzdy v rovnakom poradi, aby sa procesy navzajom nezablokovali
+      for k in sorted(by_key):
+        key = self.cache_citations[k]
+        pubs = key.get_local()
+        if pubs is None:
+          cached_value = key.__enter__()
+          opened.append(key)
+          if cached_value != None:
+            pubs = self._decode(key, cached_value)
+            if pubs is not None and key.stale:
+              stale.append(key)
+        if pubs is not None:
+          results[k] = pubs
+      
+      misses = [key for key in opened if key.key not in results]
+      if misses:
+        fetched = self.real_conn.search_citations_by_publication([by_key[key.key] for key in misses])
+        for key, pubs in zip(misses, fetched):
+          if pubs is None:
+            # zdroj publikaciu nevedel vyhladat (chyba jej identifikator
+            # alebo odkaz), prazdny vysledok necachujeme
+            results[key.key] = []
+            continue
+          self._store(key, pubs)
+          results[key.key] = pubs
+    finally:
+      for key in opened:
+        key.__exit__(None, None, None)
+    
+    if stale:
+      publication_by_key = dict((key.key, by_key[key.key]) for key in stale)
+      run_refresh_in_background(stale, lambda keys: self._refresh_citations(keys, publication_by_key))
+    
+    for publication in publications:
+      for pub in results[publication_key(publication)]:
+        yield pub.copy()
+  
+  def _refresh_citations(self, keys, publication_by_key):
+    """Obnovi stare citacie viacerych publikacii jednym volanim zdroja
+       s vlastnym spojenim, kluce, ktore obnovuje niekto iny, preskoci
+    """
+    locked = []
+    try:
+      for key in keys:
+        lock = key.try_lock()
+        if lock is not None:
+          locked.append((key, lock))
+      if not locked:
         return
-      pubs = []
-      for pub in self.real_conn.search_citations(publications):
-        yield pub
-        pubs.append(pub)
-      s = dumps([pub.to_dict() for pub in pubs])
-      key.store(s)
+      started = time.time()
+      conn = self.real.connect()
+      try:
+        results = conn.search_citations_by_publication([publication_by_key[key.key] for key, lock in locked])
+      except (Exception, ThrottleTimeout) as e:
+        logger.exception('Refreshing %d citation keys failed', len(locked))
+        for key, lock in locked:
+          key._record_refresh(started, 'error', error=str(e))
+        return
+      finally:
+        conn.close()
+      for (key, lock), pubs in zip(locked, results):
+        if pubs is None:
+          # zdroj publikaciu uz nevie vyhladat, stara hodnota ostane do hard_ttl
+          key._record_refresh(started, 'error', error='publication cannot be searched')
+          continue
+        key.store(self.codec.dumps(pubs))
+        key._record_refresh(started, 'ok')
+        key.discard_local()
+    finally:
+      for key, lock in locked:
+        lock.release()
+  
+  def can_search_citations(self, publication):
+    return self.real_conn.can_search_citations(publication)
   
   def assign_indexes(self, publications):
     return self.real_conn.assign_indexes(publications)
@@ -141,20 +479,62 @@ class RedisCachedConnection(DataSourceConnection):
       self._real_conn.close()
 
 class RequestLogger(object):
-  def __init__(self, redis, namespace):
+  def __init__(self, redis, namespace, partial_ttl=60*60):
+    """partial_ttl - po kolkych sekundach sa zahodi nedokonceny log z tee()"""
     self.redis = redis
     self.namespace = namespace
+    self.partial_ttl = partial_ttl
   
-  def log(self, method, key_data, value):
+  def _keys(self, method, key_data):
     key = hash_key(*key_data)
     method_ns = '{}:{}'.format(self.namespace, method)
     fqkey = '{}:{}:data'.format(method_ns, key)
     fqkey_params = '{}:{}:params'.format(method_ns, key)
+    return key, method_ns, fqkey, fqkey_params
+  
+  def log(self, method, key_data, value):
+    key, method_ns, fqkey, fqkey_params = self._keys(method, key_data)
     pl = self.redis.pipeline()
     pl.set(fqkey, value)
     pl.set(fqkey_params, dumps(key_data))
     pl.zadd(method_ns, time.time(), key)
     pl.execute()
+  
+  def tee(self, method, key_data, chunks):
+    """Vracia chunks a popri tom ich pripaja do logu priamo v redise,
+       takze sa cely obsah v pamati nedrzi. Zaloguje sa az po docitani,
+       nedokonceny log (chyba, volajuci prestal citat) sa zmaze.
+    """
+    key, method_ns, fqkey, fqkey_params = self._keys(method, key_data)
+    partial_key = fqkey + ':partial'
+    self.redis.delete(partial_key)
+    appended = False
+    completed = False
+    try:
+      for chunk in chunks:
+        if chunk:
+          pl = self.redis.pipeline()
+          pl.append(partial_key, chunk)
+          if not appended:
+            # ak by proces spadol skor, ako sa dostane k finally
+            pl.expire(partial_key, self.partial_ttl)
+          pl.execute()
+          appended = True
+        yield chunk
+      pl = self.redis.pipeline()
+      if appended:
+        # rename prenesie aj expire, dokonceny log ma platit natrvalo
+        pl.rename(partial_key, fqkey)
+        pl.persist(fqkey)
+      else:
+        pl.set(fqkey, '')
+      pl.set(fqkey_params, dumps(key_data))
+      pl.zadd(method_ns, time.time(), key)
+      pl.execute()
+      completed = True
+    finally:
+      if appended and not completed:
+        self.redis.delete(partial_key)
 
 class RedisLogDataSource(RedisWrappedDataSource):
   def connect(self):
@@ -180,12 +560,49 @@ class RedisLogConnection(DataSourceConnection):
       cits.append(cit)
     self.rl.log('search_citations', [[pub.to_dict() for pub in publications]], dumps([cit.to_dict() for cit in cits]))
   
+  def can_search_citations(self, publication):
+    return self.real_conn.can_search_citations(publication)
+  
+  def search_citations_by_publication(self, publications):
+    results = self.real_conn.search_citations_by_publication(publications)
+    # logujeme rovnako, ako keby sa na kazdu publikaciu pytal zvlast
+    for publication, cits in zip(publications, results):
+      if cits is not None:
+        self.rl.log('search_citations', [[publication.to_dict()]], dumps([cit.to_dict() for cit in cits]))
+    return results
+  
   def assign_indexes(self, publications):
     return self.real_conn.assign_indexes(publications)
   
   def close(self):
     self.real_conn.close()
 
+class RedisEditionCache(object):
+  """Cache UT -> edicia pre WokWS(edition_cache=...), indexy sa menia zriedka"""
+  def __init__(self, redis, ttl=30*24*60*60, negative_ttl=24*60*60, namespace='citacie:wok:edition'):
+    """ttl - ako dlho plati najdena edicia
+       negative_ttl - ako dlho plati, ze UT nie je v ziadnej edicii (zaznam moze byt novy)
+    """
+    self.redis = redis
+    self.ttl = ttl
+    self.negative_ttl = negative_ttl
+    self.namespace = namespace
+  
+  def _key(self, ut):
+    return u'{}:{}'.format(self.namespace, ut).encode('UTF-8')
+  
+  def get_many(self, uts):
+    uts = list(uts)
+    values = self.redis.mget([self._key(ut) for ut in uts])
+    return dict((ut, value.decode('UTF-8')) for ut, value in zip(uts, values) if value is not None)
+  
+  def set_many(self, editions):
+    pipe = self.redis.pipeline(transaction=False)
+    for ut, edition in editions.iteritems():
+      ttl = self.ttl if edition else self.negative_ttl
+      pipe.setex(self._key(ut), ttl, edition.encode('UTF-8'))
+    pipe.execute()
+
 class RedisLogWokWS(WokWS):
   def __init__(self, redis=None, key=None, *args, **kwargs):
     self.redis = redis
@@ -193,7 +610,7 @@ class RedisLogWokWS(WokWS):
     super(RedisLogWokWS, self).__init__(*args, **kwargs)
   
   def connect(self):
-    return RedisLogWokWSConnection(self.redis, self.key, self.throttler, self.auth)
+    return RedisLogWokWSConnection(self.redis, self.key, self.throttler, self.auth, **self.options)
 
 class RedisLogWokWSConnection(WokWSConnection):
   def __init__(self, redis, key, *args, **kwargs):
@@ -212,9 +629,12 @@ class RedisLogWokWeb(WokWeb):
     super(RedisLogWokWeb, self).__init__(*args, **kwargs)
   
   def connect(self):
-    return RedisLogWokWebConnection(self.redis, self.key, self.url, self.throttler, additional_headers=self.additional_headers)
+    return RedisLogWokWebConnection(self.redis, self.key, self.url, self.throttler, additional_headers=self.additional_headers,
+                                    export_workers=self.export_workers, sessions=self.sessions)
 
 class RedisLogWokWebConnection(WokWebConnection):
+  logs_tab_delimited = True
+  
   def __init__(self, redis, key, *args, **kwargs):
     self.rl = RequestLogger(redis, 'citacie:log:request:{}'.format(key))
     super(RedisLogWokWebConnection, self).__init__(*args, **kwargs)
@@ -229,14 +649,15 @@ class RedisLogScopusWeb(ScopusWeb):
     super(RedisLogScopusWeb, self).__init__(*args, **kwargs)
   
   def connect(self):
-    return RedisLogScopusWebConnection(self.redis, self.key, self.throttler, additional_headers=self.additional_headers, proxies=self.proxies)
+    return RedisLogScopusWebConnection(self.redis, self.key, self.throttler, additional_headers=self.additional_headers, proxies=self.proxies,
+                                       citation_workers=self.citation_workers, sessions=self.sessions)
 
 class RedisLogScopusWebConnection(ScopusWebConnection):
   def __init__(self, redis, key, *args, **kwargs):
     self.rl = RequestLogger(redis, 'citacie:log:request:{}'.format(key))
     super(RedisLogScopusWebConnection, self).__init__(*args, **kwargs)
   
-  def _log_csv(self, context, content, encoding='UTF-8'):
+  def _tee_csv(self, context, chunks, encoding='UTF-8'):
     if context is None:
-      return
-    self.rl.log(context[0], context[1:], content)
+      return chunks
+    return self.rl.tee(context[0], context[1:], chunks)
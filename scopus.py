@@ -1,22 +1,37 @@
 # -*- coding: utf-8 -*-
-from data_source import DataSource, DataSourceConnection
+from data_source import DataSource, DataSourceConnection, citations_by_publication
 from model import Publication, Author, Identifier, URL, Index
 from htmlform import HTMLForm
-from util import strip_bom, make_page_range
-from throttle import ThreadingThrottler
+from util import strip_bom, make_page_range, iter_lines
+from throttle import ThreadingThrottler, INTERACTIVE, BULK
+from htmlpage import HTMLPage
+from sessionpool import SessionPool, ThreadSessions
 
 from collections import OrderedDict
-from urllib import urlencode, quote
 import requests
 from requests.utils import add_dict_to_cookiejar
-import html5lib
 import unicodecsv
 from urlparse import urlparse, parse_qs
 import re
 import logging
+from contextlib import closing
+import itertools
+from multiprocessing.pool import ThreadPool
+
+# Scopus oddeluje ciarkou aj priezviska od mien, aj jednotlivych autorov
+AUTHOR_END_RE = re.compile(r'\.,')
+SUBSERIES_RE = re.compile(r' \(including subseries [^)]+\)')
+
+def warm_up_session(session):
+  """Cookies, ktore Scopus ocakava od prehliadaca s javascriptom"""
+  add_dict_to_cookiejar(session.cookies, {'javaScript': 'true'})
 
 class ScopusWeb(DataSource):
-  def __init__(self, additional_headers=None, throttler=None, proxies=None):
+  def __init__(self, additional_headers=None, throttler=None, proxies=None, citation_workers=1, sessions=None):
+    """citation_workers - pre kolko publikacii naraz hladat citacie, kazdy worker
+                          ma vlastnu session, celkovu rychlost stale urcuje throttler
+       sessions - SessionPool zdielany vsetkymi connections, default s additional_headers a proxies
+    """
     if additional_headers == None:
       additional_headers = {'User-agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:24.0) Gecko/20100101 Firefox/24.0'}
     self.additional_headers = additional_headers
@@ -24,27 +39,49 @@ class ScopusWeb(DataSource):
     if throttler == None:
       throttler = ThreadingThrottler(number=1, period=1, min_delay=1, finished_delay=0.5, timeout=60)
     self.throttler = throttler
+    self.citation_workers = citation_workers
+    if sessions == None:
+      sessions = SessionPool(headers=additional_headers, proxies=proxies, warm_up=warm_up_session)
+    self.sessions = sessions
     
   def connect(self):
-    return ScopusWebConnection(self.throttler, additional_headers=self.additional_headers, proxies=self.proxies)
+    return ScopusWebConnection(self.throttler, additional_headers=self.additional_headers, proxies=self.proxies,
+                               citation_workers=self.citation_workers, sessions=self.sessions)
   
 class ScopusWebConnection(DataSourceConnection):
-  def __init__(self, throttler, additional_headers=None, proxies=None):
+  def __init__(self, throttler, additional_headers=None, proxies=None, citation_workers=1, sessions=None):
     self.additional_headers = additional_headers
-    self.session = requests.Session()
-    if additional_headers:
-      self.session.headers.update(additional_headers)
-    if proxies:
-      self.session.proxies.update(proxies)
+    self.proxies = proxies
+    if sessions == None:
+      sessions = SessionPool(max_idle_sessions=0, headers=additional_headers, proxies=proxies,
+                             warm_up=warm_up_session)
+    self.sessions = sessions
     self.throttler = throttler
+    self.citation_workers = citation_workers
+    self._thread_sessions = ThreadSessions(sessions)
+  
+  @property
+  def session(self):
+    """Session pre aktualne vlakno, Scopus si stav vyhladavania drzi v cookies"""
+    return self._thread_sessions.get()
+  
+  def _map_citation_lookups(self, map, items):
+    """map(lookup, items) pre workerov, kazdy vrati svoju session, ked skonci"""
+    def lookup(item):
+      try:
+        return list(self._get_citations_from_detail_url(*item))
+      finally:
+        self._thread_sessions.release()
+    return map(lookup, items)
   
   def search_by_author_old(self, surname, name=None, year=None):
     form_url = 'http://www.scopus.com/search/form.url?display=authorLookup'
     post_url = 'http://www.scopus.com/search/submit/authorlookup.url'
     post2_url = 'http://www.scopus.com/results/authorLookup.url'
     
-    with self.throttler():
+    with self.throttler(INTERACTIVE) as request:
       r_form = self.session.get(form_url)
+      request.check_status(r_form.status_code)
     
     data = [
       ('origin', 'searchauthorlookup'),
@@ -67,20 +104,19 @@ class ScopusWebConnection(DataSourceConnection):
     headers = {'Referer': r_form.url}
     add_dict_to_cookiejar(self.session.cookies, {'javaScript': 'true'})
     
-    with self.throttler():
+    with self.throttler(INTERACTIVE) as request:
       r_results = self.session.post(post_url, data=data, headers=headers)
+      request.check_status(r_results.status_code)
     
-    et = html5lib.parse(r_results.text, treebuilder="lxml")
-    
-    namespaces = {'html': 'http://www.w3.org/1999/xhtml'}
-    errors = et.xpath(".//html:form[@name='AuthorLookupResultsForm']//*[contains(concat(' ', normalize-space(@class), ' '), ' errText ')]", namespaces=namespaces)
+    page = HTMLPage(r_results)
+    errors = page.xpath(".//html:form[@name='AuthorLookupResultsForm']//*[contains(concat(' ', normalize-space(@class), ' '), ' errText ')]", exact=True)
 
     for error in errors:
       if error.text.strip() == 'No authors were found':
         return
       raise IOError('Error encountered during author search: ' + error.text.strip())
     
-    authors_form = et.find("//{http://www.w3.org/1999/xhtml}form[@name='AuthorLookupResultsForm']")
+    authors_form = page.find("//{http://www.w3.org/1999/xhtml}form[@name='AuthorLookupResultsForm']", exact=True)
     
     form2 = HTMLForm(authors_form)
     for cb in ['allField', 'pageField', 'allField2', 'pageField2']:
@@ -91,10 +127,11 @@ class ScopusWebConnection(DataSourceConnection):
     
     headers = {'Referer': r_results.url}
     
-    with self.throttler():
+    with self.throttler(INTERACTIVE) as request:
       r_results2 = self.session.post(post2_url, data=form2.to_params(), headers=headers)
+      request.check_status(r_results2.status_code)
     
-    for pub in self._download_from_results_form(r_results2, context=['_search_by_author', surname, name]):
+    for pub in self._download_from_results_form(HTMLPage(r_results2), context=['_search_by_author', surname, name]):
       if year == None or pub.year == year:
         yield pub
   
@@ -102,14 +139,13 @@ class ScopusWebConnection(DataSourceConnection):
     form_url = 'http://www.scopus.com'
     post_url = 'http://www.scopus.com/search/submit/basic.url'
     
-    with self.throttler():
+    with self.throttler(INTERACTIVE) as request:
       r_form = self.session.get(form_url)
+      request.check_status(r_form.status_code)
     
     add_dict_to_cookiejar(self.session.cookies, {'javaScript': 'true', 'xmlHttpRequest': 'true'})
     
-    et = html5lib.parse(r_form.text, treebuilder="lxml")
-    namespaces = {'html': 'http://www.w3.org/1999/xhtml'}
-    search_form_html = et.find("//{http://www.w3.org/1999/xhtml}form[@name='SearchResultsForm']")
+    search_form_html = HTMLPage(r_form).find("//{http://www.w3.org/1999/xhtml}form[@name='SearchResultsForm']", exact=True)
     
     search_form = HTMLForm(search_form_html)
     search_term = surname
@@ -124,25 +160,25 @@ class ScopusWebConnection(DataSourceConnection):
     
     headers = {'Referer': r_form.url}
     
-    with self.throttler():
+    with self.throttler(INTERACTIVE) as request:
       r_results = self.session.post(post_url, data=search_form.to_params(), headers=headers)
+      request.check_status(r_results.status_code)
     
-    et = html5lib.parse(r_results.text, treebuilder="lxml")
-    namespaces = {'html': 'http://www.w3.org/1999/xhtml'}
-    errors = et.xpath(".//html:form[@name='SearchResultsForm']//*[contains(concat(' ', normalize-space(@class), ' '), ' errText ')]", namespaces=namespaces)
+    # stranka s vysledkami sa parsuje len raz, _download_from_results_form dostane uz HTMLPage
+    results_page = HTMLPage(r_results)
+    errors = results_page.xpath(".//html:form[@name='SearchResultsForm']//*[contains(concat(' ', normalize-space(@class), ' '), ' errText ')]", exact=True)
 
     for error in errors:
       if error.text.strip() == 'No results were found.':
         return []
       raise IOError('Error encountered during document search: ' + error.text.strip())
     
-    return self._download_from_results_form(r_results, context=['_search_by_author', surname, name, year])
+    return self._download_from_results_form(results_page, context=['_search_by_author', surname, name, year])
 
-  def _download_from_results_form(self, results_form_response, context=None):
+  def _download_from_results_form(self, results_page, context=None, priority=INTERACTIVE):
     handle_results_url = 'http://www.scopus.com/results/handle.url'
     
-    et = html5lib.parse(results_form_response.text, treebuilder="lxml")
-    results_form = et.find("//{http://www.w3.org/1999/xhtml}form[@name='SearchResultsForm']")
+    results_form = results_page.find("//{http://www.w3.org/1999/xhtml}form[@name='SearchResultsForm']", exact=True)
     form = HTMLForm(results_form)
     
     form.check_all('selectedEIDs')
@@ -151,18 +187,18 @@ class ScopusWebConnection(DataSourceConnection):
     form.check_all('selectAllCheckBox')
     form.check_all('selectPageCheckBox')
     
-    headers = {'Referer': results_form_response.url}
+    headers = {'Referer': results_page.url}
     
-    with self.throttler():
+    with self.throttler(priority) as request:
       r_results3 = self.session.post(handle_results_url, data=form.to_params(), headers=headers)
+      request.check_status(r_results3.status_code)
     
-    return self._download_from_export_form(r_results3, context=context)
+    return self._download_from_export_form(HTMLPage(r_results3), context=context, priority=priority)
   
-  def _download_from_export_form(self, export_form_response, context=None):
+  def _download_from_export_form(self, export_page, context=None, priority=INTERACTIVE):
     export_url = 'http://www.scopus.com/onclick/export.url'
     
-    et = html5lib.parse(export_form_response.text, treebuilder="lxml")
-    export_form = et.find("//{http://www.w3.org/1999/xhtml}form[@name='exportForm']")
+    export_form = export_page.find("//{http://www.w3.org/1999/xhtml}form[@name='exportForm']", exact=True)
 
     if export_form is None:
         return []
@@ -182,19 +218,56 @@ class ScopusWebConnection(DataSourceConnection):
    #])
     form.set_value('oneClickExport', '{"Format":"CSV","SelectedFields":"Link Authors Title Year SourceTitle Volume Issue ArtNo PageStart PageEnd PageCount DocumentType CitedBy Source ISSN ISBN CODE  DOI Publisher ","View":"SpecifyFields"}')
     
-    headers = {'Referer': export_form_response.url}
-    with self.throttler():
-      csv = self.session.get(export_url, params=form.to_params(), headers=headers)
-    
-    self._log_csv(context, csv.content, encoding=csv.encoding)
-    
-    return self._parse_csv(csv.content, encoding=csv.encoding)
+    headers = {'Referer': export_page.url}
+    return self._export_csv(export_url, form.to_params(), headers, context, priority)
   
-  def _log_csv(self, context, content, encoding='UTF-8'):
-    pass
+  def _export_csv(self, url, params, headers, context, priority):
+    # request v throttleri konci az ked je export cely stiahnuty (alebo zatvoreny),
+    # aby sa dalsi nezacal, kym sa este stahuje telo
+    with self.throttler(priority) as request:
+      csv = self.session.get(url, params=params, headers=headers, stream=True)
+      request.check_status(csv.status_code)
+      for pub in self._read_csv(csv, context):
+        yield pub
+  
+  def _read_csv(self, response, context):
+    """Parsuje CSV export uz pocas stahovania"""
+    encoding = response.encoding or 'UTF-8'
+    with closing(response):
+      chunks = self._tee_csv(context, response.iter_content(64 * 1024), encoding=encoding)
+      for pub in self._parse_csv(iter_lines(chunks), encoding=encoding):
+        yield pub
+  
+  def _tee_csv(self, context, chunks, encoding='UTF-8'):
+    """Vrati chunks, podtriedy ich mozu popri tom logovat"""
+    return chunks
   
-  def _parse_csv(self, content, encoding='UTF-8'):
-    csv = unicodecsv.DictReader(strip_bom(content).splitlines(), encoding=encoding)
+  def _parse_csv(self, lines, encoding='UTF-8'):
+    """lines - iterator riadkov CSV v bajtoch alebo cely obsah"""
+    if isinstance(lines, str):
+      lines = lines.splitlines()
+    lines = iter(lines)
+    header = next(lines, None)
+    if header == None:
+      return
+    lines = itertools.chain([strip_bom(header)], lines)
+    csv = unicodecsv.reader(lines, encoding=encoding)
+    columns = next(csv)
+    col_authors = columns.index('Authors')
+    col_title = columns.index('Title')
+    col_year = columns.index('Year')
+    col_source_title = columns.index('Source title')
+    col_volume = columns.index('Volume')
+    col_issue = columns.index('Issue')
+    col_page_start = columns.index('Page start')
+    col_page_end = columns.index('Page end')
+    col_doilink = columns.index('DOILink')
+    col_cited_by = columns.index('Cited by')
+    col_article_no = columns.index('Art. No.')
+    col_publisher = columns.index('Publisher')
+    col_issn = columns.index('ISSN')
+    col_isbn = columns.index('ISBN')
+    column_count = len(columns)
     
     def empty_to_none(s):
       if s == None:
@@ -219,7 +292,12 @@ class ScopusWebConnection(DataSourceConnection):
       return int(x)
     
     for line in csv:
-      if line['Authors'] == '[No author name available]':
+      # prazdne riadky (napr. na konci exportu) preskocime
+      if not line:
+        continue
+      if len(line) < column_count:
+        line.extend([u''] * (column_count - len(line)))
+      if line[col_authors] == '[No author name available]':
         authors = []
       else:
         # (mrshu): SCOPUS sa rozhodol oddelovat ako priezvyska, tak aj
@@ -231,36 +309,35 @@ class ScopusWebConnection(DataSourceConnection):
         # najdeme, konce celych mien, a ciarku v tomto pripade nahradime
         # bodkociarkou. Nasledne potom funkcii, ktora mena autorov spracovava
         # dame vediet, ze je ako separator pouzita bodkociarka.
-        line['Authors'] = re.sub(r'\.,', ';', line['Authors'])
-        authors = Author.parse_sn_first_list(line['Authors'], separator=u';')
-      pub = Publication(line['Title'], authors, to_num(line['Year']))
-      source_title = empty_to_none(line['Source title'])
+        authors = Author.parse_sn_first_list(AUTHOR_END_RE.sub(u';', line[col_authors]), separator=u';')
+      pub = Publication(line[col_title], authors, to_num(line[col_year]))
+      source_title = empty_to_none(line[col_source_title])
       if source_title:
-        source_title, replacements = re.subn(r' \(including subseries [^)]+\)', '', source_title)
+        source_title, replacements = SUBSERIES_RE.subn(u'', source_title)
         source_title = source_title.strip()
         if replacements:
           pub.series = source_title
         else:
           pub.published_in = source_title
-      pub.volume = empty_to_none(line['Volume'])
-      pub.issue = empty_to_none(line['Issue'])
-      pub.pages = make_page_range(empty_to_none(line['Page start']), empty_to_none(line['Page end']))
+      pub.volume = empty_to_none(line[col_volume])
+      pub.issue = empty_to_none(line[col_issue])
+      pub.pages = make_page_range(empty_to_none(line[col_page_start]), empty_to_none(line[col_page_end]))
 
       # (mrshu): z dovodu, ktory nedokazem pochopit teraz SCOPUS vracia cosi
       # ako 'DOILink', kde da dohromady tieto dva fieldy. Nepodarilo sa mi
       # prist na to ako to spravit rozumnejsie, tento hack to aspon rozparsuje
-      splits = line['DOILink'].split('"')
+      splits = line[col_doilink].split('"')
       if len(splits) > 1:
-          line['Link'] = splits[1]
-          line['DOI'] = splits[0]
+          link = splits[1]
+          doi = splits[0]
       else:
-          line['Link'] = splits[0]
-          line['DOI'] = None
+          link = splits[0]
+          doi = None
 
-      pub.times_cited = empty_to_none(line['Cited by'])
-      pub.article_no = empty_to_none(line['Art. No.'])
-      pub.publisher = empty_to_none(line['Publisher'])
-      url = empty_to_none(line['Link'])
+      pub.times_cited = empty_to_none(line[col_cited_by])
+      pub.article_no = empty_to_none(line[col_article_no])
+      pub.publisher = empty_to_none(line[col_publisher])
+      url = empty_to_none(link)
       
       if url:
         pub.source_urls.append(URL(url, type='SCOPUS', description='SCOPUS'))
@@ -269,13 +346,13 @@ class ScopusWebConnection(DataSourceConnection):
         if 'eid' in url_query and len:
           pub.identifiers.append(Identifier(url_query['eid'][0], type='SCOPUS'))
       
-      for issn in list_remove_empty(line['ISSN'].split(u';')):
+      for issn in list_remove_empty(line[col_issn].split(u';')):
         pub.identifiers.append(Identifier(issn, type='ISSN'))
       
-      for isbn in list_remove_empty(line['ISBN'].split(u';')):
+      for isbn in list_remove_empty(line[col_isbn].split(u';')):
         pub.identifiers.append(Identifier(isbn, type='ISBN'))
       
-      doi = empty_to_none(line['DOI'])
+      doi = empty_to_none(doi)
       if doi:
         pub.identifiers.append(Identifier(doi, type='DOI'))
       
@@ -283,29 +360,71 @@ class ScopusWebConnection(DataSourceConnection):
       
       yield pub
   
+  def _citation_lookup(self, publication):
+    """(detail_url, eid) pre hladanie citacii publikacie alebo None"""
+    eid = list(Identifier.find_by_type(publication.identifiers, 'SCOPUS'))
+    if len(eid) == 0:
+      return None
+    detail_url = list(URL.find_by_type(publication.source_urls, 'SCOPUS'))
+    if len(detail_url) == 0:
+      return None
+    return (detail_url[0].value, eid[0].value)
+  
+  def can_search_citations(self, publication):
+    return self._citation_lookup(publication) is not None
+  
+  def search_citations_by_publication(self, publications):
+    lookups = [self._citation_lookup(publication) for publication in publications]
+    unique = list(OrderedDict.fromkeys(lookup for lookup in lookups if lookup is not None))
+    
+    workers = min(self.citation_workers, len(unique))
+    if workers <= 1:
+      found = dict((item, list(self._get_citations_from_detail_url(*item))) for item in unique)
+    else:
+      pool = ThreadPool(workers)
+      try:
+        found = dict(zip(unique, self._map_citation_lookups(pool.map, unique)))
+      finally:
+        pool.terminate()
+        pool.join()
+    return citations_by_publication(lookups, found)
+  
   def search_citations(self, publications):
+    lookups = []
     for publication in publications:
-      eid = list(Identifier.find_by_type(publication.identifiers, 'SCOPUS'))
-      if len(eid) == 0:
-        continue
-      eid = eid[0].value
-      detail_url = list(URL.find_by_type(publication.source_urls, 'SCOPUS'))
-      if len(detail_url) == 0:
-        continue
-      detail_url = detail_url[0].value
-      for pub in self._get_citations_from_detail_url(detail_url, eid):
-        yield pub
+      lookup = self._citation_lookup(publication)
+      if lookup is not None:
+        lookups.append(lookup)
+    
+    workers = min(self.citation_workers, len(lookups))
+    if workers <= 1:
+      for detail_url, eid in lookups:
+        for pub in self._get_citations_from_detail_url(detail_url, eid):
+          yield pub
+      return
+    
+    # kazdy worker pouziva vlastnu session (self.session je per vlakno),
+    # citacie publikacie vraciame hned, ako je cela hotova
+    pool = ThreadPool(workers)
+    try:
+      for pubs in self._map_citation_lookups(pool.imap_unordered, lookups):
+        for pub in pubs:
+          yield pub
+    finally:
+      # ak nas prestanu citat, dalsie publikacie uz nezaciname
+      pool.terminate()
+      pool.join()
   
   def _get_citations_from_detail_url(self, detail_url, eid):
     add_dict_to_cookiejar(self.session.cookies, {'javaScript': 'true'})
-    with self.throttler():
+    with self.throttler(BULK) as request:
       r = self.session.get(detail_url)
+      request.check_status(r.status_code)
     
-    et = html5lib.parse(r.text, treebuilder="lxml")
+    page = HTMLPage(r)
     
-    def get_cited_by_link(et):
-      namespaces = {'html': 'http://www.w3.org/1999/xhtml'}
-      cite_links = et.xpath(".//html:a[starts-with(@href, 'http://www.scopus.com/search/submit/citedby.url') and @title='View all citing documents']", namespaces=namespaces)
+    def get_cited_by_link(page):
+      cite_links = page.xpath(".//html:a[starts-with(@href, 'http://www.scopus.com/search/submit/citedby.url') and @title='View all citing documents']", required=True)
       
       for link in cite_links:
         if 'title' in link.attrib:
@@ -314,24 +433,25 @@ class ScopusWebConnection(DataSourceConnection):
       
       return None
     
-    link = get_cited_by_link(et)
+    link = get_cited_by_link(page)
     if link == None:
       logging.warning('No SCOPUS citation link found')
       return []
     
     headers = {'Referer': r.url}
     
-    with self.throttler():
+    with self.throttler(BULK) as request:
       r2 = self.session.get(link, headers=headers)
+      request.check_status(r2.status_code)
     
-    return self._download_from_results_form(r2, context=['_get_citations_from_detail_url', detail_url, eid])
+    return self._download_from_results_form(HTMLPage(r2), context=['_get_citations_from_detail_url', detail_url, eid], priority=BULK)
     
   
   def assign_indexes(self, publications):
     pass
   
   def close(self):
-    self.session.close()
+    self._thread_sessions.close()
 
 if __name__ == '__main__':
   with ScopusWeb().connect() as conn:
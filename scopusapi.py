@@ -1,30 +1,92 @@
 # -*- coding: utf-8 -*-
-from data_source import DataSource, DataSourceConnection
+from data_source import DataSource, DataSourceConnection, citations_by_publication
 from model import Publication, Author, Identifier, URL, Index
 from htmlform import HTMLForm
 from util import strip_bom, make_page_range
-from throttle import ThreadingThrottler
+from throttle import ThreadingThrottler, INTERACTIVE, BULK
+from sessionpool import SessionPool, CONNECTIONS_PER_HOST
 
 from collections import OrderedDict
 from urllib import urlencode, quote
-import requests
 from requests.utils import add_dict_to_cookiejar
+from multiprocessing.pool import ThreadPool
 import re
+import logging
+
+logger = logging.getLogger('citacie.scopusapi')
 
 INCLUDING_RE = r' \(including subseries [^)]+\)'
 
+SEARCH_URL = 'https://api.elsevier.com/content/search/scopus'
+
+# polia, bez ktorych entries_to_publications nevie vytvorit publikaciu,
+# pridavaju sa ku kazdej projekcii field=
+REQUIRED_FIELDS = ('eid', 'dc:title', 'author', 'author-count',
+                   'prism:coverDate', 'citedby-count', 'link')
+
 
 class ScopusAPI(DataSource):
-    def __init__(self, api_key):
+    def __init__(self, api_key, sessions=None, page_size=25, page_workers=4,
+                 batch_citations=False, throttler=None):
+        """sessions - SessionPool zdielany vsetkymi connections, jej
+                      connections_per_host ma byt aspon page_workers
+           page_size - kolko vysledkov pytat na jednu stranku (count=)
+           page_workers - kolko stranok vysledkov stahovat naraz (stale cez
+                          throttler), vsetky cez jednu session connection-u
+           batch_citations - citacie vsetkych publikacii stahovat naraz, kazdu
+                             citujucu len raz, oplati sa ak sa citacie vybranych
+                             publikacii vo velkom prekryvaju
+        """
         self.api_key = api_key
+        if throttler is None:
+            throttler = ThreadingThrottler(number=5, period=1, timeout=60)
+        self.throttler = throttler
+        if sessions is None:
+            sessions = SessionPool(
+                connections_per_host=max(page_workers, CONNECTIONS_PER_HOST),
+                headers={'Accept': 'application/json'})
+        elif sessions.connections_per_host < page_workers:
+            logger.warning('Session pool keeps %d connections per host, '
+                           'some of %d page workers will reconnect',
+                           sessions.connections_per_host, page_workers)
+        self.sessions = sessions
+        self.page_size = page_size
+        self.page_workers = page_workers
+        self.batch_citations = batch_citations
 
     def connect(self):
-        return ScopusAPIConnection(api_key=self.api_key)
+        return ScopusAPIConnection(api_key=self.api_key,
+                                   throttler=self.throttler,
+                                   sessions=self.sessions,
+                                   page_size=self.page_size,
+                                   page_workers=self.page_workers,
+                                   batch_citations=self.batch_citations)
 
 
 class ScopusAPIConnection(DataSourceConnection):
-    def __init__(self, api_key):
+    # Search API nevrati vysledky s offsetom (start) za touto hranicou
+    max_results = 5000
+    # dlzka dotazu s viacerymi EID(), aby sa zmestil do URL
+    max_query_length = 2000
+    # kolko eid na stranku pri dotazoch, ktore stahuju len pole eid
+    eid_page_size = 200
+
+    def __init__(self, api_key, throttler, sessions=None, page_size=25,
+                 page_workers=4, batch_citations=False):
         self.api_key = api_key
+        self.throttler = throttler
+        if sessions is None:
+            sessions = SessionPool(
+                max_idle_sessions=0,
+                connections_per_host=max(page_workers, CONNECTIONS_PER_HOST),
+                headers={'Accept': 'application/json'})
+        self.sessions = sessions
+        self.page_size = page_size
+        self.page_workers = page_workers
+        self.batch_citations = batch_citations
+        # API nema stav v cookies, page workers zdielaju jednu session
+        # (a jej pool spojeni)
+        self.session = sessions.checkout()
 
     def find_next_url(self, links, ref='next'):
         for link in links:
@@ -32,37 +94,99 @@ class ScopusAPIConnection(DataSourceConnection):
                 return link['@href']
         return None
 
-    def publications_from_query(self, query):
-        url = 'https://api.elsevier.com/content/search/scopus'
-
-        params = {
-            'apiKey': self.api_key,
-            'view': 'complete',
-            'query': query
-        }
-        raw_json = requests.get(url, params=params).json()
-        search_results = raw_json['search-results']
+    def _search_params(self, query, start, count, view, field):
+        params = OrderedDict()
+        params['apiKey'] = self.api_key
+        params['view'] = view
+        params['query'] = query
+        params['start'] = start
+        params['count'] = count
+        if field is not None:
+            params['field'] = ','.join(field)
+        return params
+
+    def _search_page(self, query, start, count, view, field, priority):
+        """Jedna stranka vysledkov od offsetu start"""
+        params = self._search_params(query, start, count, view, field)
+        with self.throttler(priority) as request:
+            r = self.session.get(SEARCH_URL, params=params)
+            request.check_status(r.status_code)
+        r.raise_for_status()
+        return r.json()['search-results']
+
+    def _page_offsets(self, total_results, count):
+        """Offsety (start) stranok po prvej"""
+        end = min(total_results, self.max_results)
+        if total_results > end:
+            logger.warning('Query has %d results, only first %d are available',
+                           total_results, end)
+        return range(count, end, count)
+
+    def _iter_entries(self, query, field=None, view='complete', count=None,
+                      priority=INTERACTIVE):
+        """Vrati entries (json) vyhovujuce query.
+
+        Prva stranka urci pocet vysledkov (opensearch:totalResults), ostatne
+        stranky sa stahuju naraz cez page_workers, kym sa predosle spracuvaju.
+        """
+        if count is None:
+            count = self.page_size
+        search_results = self._search_page(query, 0, count, view, field,
+                                           priority)
         total_results = int(search_results['opensearch:totalResults'])
         if total_results == 0:
             return
 
-        entries = raw_json['search-results']['entry']
+        for entry in search_results['entry']:
+            yield entry
+
+        offsets = self._page_offsets(total_results, count)
+        if not offsets:
+            return
+
+        def get_page(start):
+            return self._search_page(query, start, count, view, field,
+                                     priority)
+
+        if self.page_workers <= 1:
+            for start in offsets:
+                for entry in get_page(start)['entry']:
+                    yield entry
+            return
+
+        pool = ThreadPool(min(self.page_workers, len(offsets)))
+        try:
+            # imap vracia stranky v poradi, dalsie sa medzitym stahuju
+            for page in pool.imap(get_page, offsets):
+                for entry in page['entry']:
+                    yield entry
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _projection(self, field):
+        """Polia pre field=, doplnene o tie, ktore potrebuje
+        entries_to_publications"""
+        if field is None:
+            return None
+        if isinstance(field, basestring):
+            field = field.split(',')
+        fields = list(field)
+        fields.extend(f for f in REQUIRED_FIELDS if f not in fields)
+        return fields
+
+    def publications_from_query(self, query, field=None,
+                                priority=INTERACTIVE):
+        """Vrati publikacie vyhovujuce query.
+
+        field - zoznam poli, ktore sa maju stiahnut (projekcia), polia
+                potrebne na vytvorenie publikacie sa pridaju vzdy
+        """
+        entries = self._iter_entries(query, field=self._projection(field),
+                                     priority=priority)
         for pub in self.entries_to_publications(entries):
             yield pub
 
-        while True:
-            next_link = self.find_next_url(raw_json['search-results']['link'])
-            if next_link is None:
-                break
-            # (mrshu): hotfix pre scopus, z nejakeho dovodu ocakavaju, ze HTTPS
-            # pojde aj na porte 80
-            next_link = next_link.replace('api.elsevier.com:80',
-                                          'api.elsevier.com:443')
-            raw_json = requests.get(next_link).json()
-            entries = raw_json['search-results']['entry']
-            for pub in self.entries_to_publications(entries):
-                yield pub
-
     def search_by_author(self, surname, name=None, year=None):
         query = '{}'.format(surname)
         if name is not None:
@@ -171,22 +295,123 @@ class ScopusAPIConnection(DataSourceConnection):
         """Vrati iterator vracajuci zoznam publikacii, ktore cituju dane
         eid."""
         query = "refeid('{}')".format(eid)
-        for pub in self.publications_from_query(query):
+        for pub in self.publications_from_query(query, priority=BULK):
             yield pub
 
+    def _query_batches(self, term, values):
+        """Spoji term.format(value) pre vsetky values cez OR do dotazov
+        najviac max_query_length znakov dlhych"""
+        terms = []
+        length = 0
+        for value in values:
+            t = term.format(value)
+            if terms and length + len(' OR ') + len(t) > self.max_query_length:
+                yield ' OR '.join(terms)
+                terms = []
+                length = 0
+            if terms:
+                length += len(' OR ')
+            terms.append(t)
+            length += len(t)
+        if terms:
+            yield ' OR '.join(terms)
+
+    def _citing_eids(self, eid):
+        """Zoznam eid publikacii citujucich eid, stahuje sa len pole eid"""
+        entries = self._iter_entries("refeid('{}')".format(eid),
+                                     field=['eid'], view='standard',
+                                     count=self.eid_page_size, priority=BULK)
+        return list(OrderedDict.fromkeys(entry['eid'] for entry in entries))
+
+    def search_citations_by_eids(self, eids, field=None):
+        """Vrati OrderedDict eid -> zoznam publikacii, ktore ho cituju.
+
+        Pre kazde eid sa najprv zisti len zoznam eid citujucich publikacii
+        (200 na stranku), cele zaznamy sa potom stahuju raz pre ich zjednotenie
+        cez EID(..) OR EID(..). Oproti samostatnemu refeid() dotazu pre kazde
+        eid to usetri requesty len ked sa citacie vybranych publikacii vo
+        velkom prekryvaju alebo ich je vela.
+        """
+        eids = list(OrderedDict.fromkeys(eids))
+        citing = OrderedDict((eid, self._citing_eids(eid)) for eid in eids)
+        union = OrderedDict.fromkeys(citing_eid
+                                     for citing_eids in citing.values()
+                                     for citing_eid in citing_eids)
+
+        converted = {}
+        for query in self._query_batches('EID({})', union):
+            entries = OrderedDict()
+            for entry in self._iter_entries(query,
+                                            field=self._projection(field),
+                                            priority=BULK):
+                entries.setdefault(entry['eid'], entry)
+            converted.update(zip(entries.keys(),
+                                 self.entries_to_publications(
+                                     entries.values())))
+
+        citations = OrderedDict()
+        returned = set()
+        for eid in eids:
+            pubs = []
+            for citing_eid in citing[eid]:
+                # mohla medzi dotazmi zmiznut
+                if citing_eid not in converted:
+                    continue
+                pub = converted[citing_eid]
+                # volajuci publikacie upravuju, kazdy zoznam ma vlastne
+                if citing_eid in returned:
+                    pub = pub.copy()
+                returned.add(citing_eid)
+                pubs.append(pub)
+            citations[eid] = pubs
+        return citations
+
+    def _eid(self, publication):
+        eid = list(Identifier.find_by_type(publication.identifiers, 'SCOPUS'))
+        if len(eid) == 0:
+            return None
+        return eid[0].value
+
+    def can_search_citations(self, publication):
+        return self._eid(publication) is not None
+
+    def search_citations_by_publication(self, publications):
+        eids = [self._eid(publication) for publication in publications]
+        unique = list(OrderedDict.fromkeys(eid for eid in eids
+                                           if eid is not None))
+        if self.batch_citations:
+            citations = self.search_citations_by_eids(unique)
+        else:
+            citations = dict((eid, list(self.search_citations_by_eid(eid)))
+                             for eid in unique)
+
+        return citations_by_publication(eids, citations)
+
     def search_citations(self, publications):
         """Vrati iterator vracajuci zoznam publikacii, ktore cituju publikacie
            v zozname publications
         """
+        eids = []
         for publication in publications:
-            eid = list(Identifier.find_by_type(publication.identifiers,
-                                               'SCOPUS'))
-            if len(eid) == 0:
+            eid = self._eid(publication)
+            if eid is None:
                 continue
-            eid = eid[0].value
+            eids.append(eid)
 
-            for pub in self.search_citations_by_eid(eid):
-                yield pub
+        if not self.batch_citations:
+            for eid in eids:
+                for pub in self.search_citations_by_eid(eid):
+                    yield pub
+            return
+
+        # rovnako ako bez davok, publikacia citujuca viacero z eids
+        # sa vrati pre kazdu z nich
+        citations = self.search_citations_by_eids(eids)
+        returned = set()
+        for eid in eids:
+            for pub in citations[eid]:
+                yield pub.copy() if eid in returned else pub
+            returned.add(eid)
 
     def assign_indexes(self, publications):
         """Zisti a nastavi, v akych indexoch sa publikacie nachadzaju
@@ -194,7 +419,9 @@ class ScopusAPIConnection(DataSourceConnection):
         pass
 
     def close(self):
-        pass
+        if self.session is not None:
+            self.sessions.checkin(self.session)
+            self.session = None
 
 if __name__ == '__main__':
     with ScopusAPI(api_key='').connect() as conn:
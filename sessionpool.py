@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger('citacie.sessionpool')
+
+# default velkost pool-u spojeni v jednej session
+CONNECTIONS_PER_HOST = 10
+
+class SessionPool(object):
+  """Pool requests.Session objektov zdielany connection-ami jedneho DataSource.
+     Session si connection pozica (checkout) a vracia pri close() (checkin),
+     takze keep-alive spojenia aj cookies (prihlasenie) prezivaju medzi requestami.
+  """
+  def __init__(self, max_idle_sessions=4, max_idle_time=5*60, connections_per_host=CONNECTIONS_PER_HOST,
+               headers=None, proxies=None, warm_up=None, clock=None):
+    """
+    max_idle_sessions - kolko nepouzivanych sessions najviac drzat
+    max_idle_time - po kolkych sekundach nepouzivania sa session zatvori
+    connections_per_host - velkost pool-u spojeni v jednej session, ak session
+                           pouziva viac vlakien naraz, ma byt aspon tolko, kolko ich je
+    headers, proxies - nastavia sa kazdej novej session
+    warm_up - funkcia(session) zavolana na novej session, napr. na nastavenie cookies
+    """
+    self.max_idle_sessions = max_idle_sessions
+    self.max_idle_time = max_idle_time
+    self.connections_per_host = connections_per_host
+    self.headers = headers
+    self.proxies = proxies
+    self.warm_up = warm_up
+    if clock == None:
+      clock = time.time
+    self._clock = clock
+    # (cas vratenia, session), najcerstvejsia na konci
+    self._idle = []
+    self._lock = threading.Lock()
+    self.created = 0
+    self.reused = 0
+    self.expired = 0
+  
+  def _new_session(self):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=self.connections_per_host, pool_maxsize=self.connections_per_host)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if self.headers:
+      session.headers.update(self.headers)
+    if self.proxies:
+      session.proxies.update(self.proxies)
+    if self.warm_up != None:
+      self.warm_up(session)
+    return session
+  
+  def _expire(self):
+    """Vyberie z idle sessions tie, ktore sa dlho nepouzivali, vola sa pod zamkom"""
+    deadline = self._clock() - self.max_idle_time
+    expired = []
+    while self._idle and self._idle[0][0] < deadline:
+      expired.append(self._idle.pop(0)[1])
+    self.expired += len(expired)
+    return expired
+  
+  def checkout(self):
+    with self._lock:
+      expired = self._expire()
+      session = None
+      if self._idle:
+        session = self._idle.pop()[1]
+        self.reused += 1
+      else:
+        self.created += 1
+    for old in expired:
+      old.close()
+    if session == None:
+      logger.debug('Creating new session')
+      session = self._new_session()
+    return session
+  
+  def checkin(self, session):
+    with self._lock:
+      expired = self._expire()
+      if len(self._idle) < self.max_idle_sessions:
+        self._idle.append((self._clock(), session))
+        session = None
+    for old in expired:
+      old.close()
+    if session != None:
+      session.close()
+  
+  def clear(self):
+    with self._lock:
+      idle = self._idle
+      self._idle = []
+    for t, session in idle:
+      session.close()
+  
+  def info(self):
+    with self._lock:
+      info = OrderedDict()
+      info['idle'] = len(self._idle)
+      info['created'] = self.created
+      info['reused'] = self.reused
+      info['expired'] = self.expired
+      return info
+
+class ThreadSessions(object):
+  """Sessions, ktore si connection pozicala z SessionPool, kazde vlakno ma
+     vlastnu (napr. ked si server stav drzi v cookies). Z poolu sa pozicia az
+     pri prvom pouziti, worker ju ma vratit cez release(), ked skonci,
+     ostatne sa vratia pri close().
+  """
+  def __init__(self, pool):
+    self.pool = pool
+    self._local = threading.local()
+    self._sessions = []
+    self._lock = threading.Lock()
+  
+  def get(self):
+    """Session pre aktualne vlakno"""
+    session = getattr(self._local, 'session', None)
+    if session == None:
+      session = self.pool.checkout()
+      self._local.session = session
+      with self._lock:
+        self._sessions.append(session)
+    return session
+  
+  def release(self):
+    """Vrati session aktualneho vlakna do poolu"""
+    session = getattr(self._local, 'session', None)
+    if session == None:
+      return
+    self._local.session = None
+    with self._lock:
+      self._sessions.remove(session)
+    self.pool.checkin(session)
+  
+  def close(self):
+    with self._lock:
+      sessions = self._sessions
+      self._sessions = []
+      # sessions v threading.local ostatnych vlakien uz nepouzijeme
+      self._local = threading.local()
+    for session in sessions:
+      self.pool.checkin(session)
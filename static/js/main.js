@@ -1 +1,16 @@
-
+// Zoradi vysledky, ktore prisli postupne po zdrojoch, podla roku a nazvu
+function sortResults(container) {
+    var $container = $(container);
+    var results = $container.children('.result').map(function(index) {
+        var $el = $(this);
+        return {el: this, index: index, year: parseInt($el.data('year'), 10) || 0, title: String($el.data('title'))};
+    }).get();
+    results.sort(function(a, b) {
+        if (a.year != b.year) return a.year - b.year;
+        if (a.title != b.title) return a.title < b.title ? -1 : 1;
+        return a.index - b.index;
+    });
+    $.each(results, function(i, r) {
+        $container.append(r.el);
+    });
+}
@@ -1,7 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from model import Author
+from model import Author, Publication, Identifier, Index, URL
+from merge import find_duplicates, Merge
+from data_source import DataSource, DataSourceConnection, citations_by_publication
+from sessionpool import ThreadSessions
+import time
+import threading
+from util import LRUCache, SizedTTLCache, normalize, iter_lines
+import codec
+from throttle import Throttler, ThreadingThrottler, RedisThrottler, ThrottleTimeout, AIMD, INTERACTIVE, BULK
+from nose.plugins.skip import SkipTest
+import json
+import os
+from htmlpage import HTMLPage, parse_fast, parse_full, namespaces, XHTML_NAMESPACE
+from htmlform import HTMLForm
+from scopus import ScopusWebConnection
 
 author_parse_test_cases = [
   (u'Surname, First', Author(u'Surname', [u'First'])),
@@ -59,6 +73,464 @@ def test_author_short_name():
   for args in author_short_name_test_cases:
     yield check_author_short_name, args[0], args[1]
 
+def test_iter_lines_across_chunks():
+  text = 'a,b\r\nc\r\n\r\nlong line\nlast'
+  for size in range(1, len(text) + 1):
+    chunks = [text[i:i + size] for i in range(0, len(text), size)]
+    assert list(iter_lines(chunks)) == text.splitlines()
+
+def test_lru_cache_evicts_least_recently_used():
+  cache = LRUCache(2)
+  cache.put('a', 1)
+  cache.put('b', 2)
+  assert cache.get('a') == 1
+  cache.put('c', 3)
+  assert cache.get('b') is None
+  assert cache.get('a') == 1
+  assert cache.get('c') == 3
+  assert len(cache) == 2
+  assert (cache.hits, cache.misses) == (3, 1)
+
+def test_sized_ttl_cache():
+  now = [0]
+  cache = SizedTTLCache(10, ttl=5, clock=lambda: now[0])
+  cache.put('a', 1, 4)
+  cache.put('b', 2, 4)
+  assert cache.get('a') == 1
+  cache.put('c', 3, 4)
+  assert cache.get('b') is None
+  assert cache.size == 8
+  cache.put('huge', 4, 11)
+  assert cache.get('huge') is None
+  now[0] = 5
+  assert cache.get('a') is None
+  assert cache.size == 4
+
+def test_publication_copy_is_independent():
+  pub = Publication(u'Title', [Author(u'Smith')], 2010, errors=[u'a'])
+  pub.norm_title
+  copy = pub.copy()
+  copy.errors.append(u'b')
+  copy.title = u'Other'
+  assert pub.errors == [u'a'] and pub.title == u'Title'
+  assert copy.norm_title == u'other' and pub.norm_title == u'title'
+  assert copy.to_dict()['authors'] == pub.to_dict()['authors']
+
+def test_intern_value_bounded():
+  import model
+  assert Index(u'SCOPUS').value is Index(u'SCOPUS'.lower().upper()).value
+  long_text = u'x' * (model.INTERN_MAX_LENGTH + 1)
+  size = len(model._interned._data)
+  assert model.intern_value(long_text) is long_text
+  assert len(model._interned._data) == size
+  for i in range(model._interned.maxsize + 10):
+    model.intern_value(u'value {}'.format(i))
+  assert len(model._interned._data) == model._interned.maxsize
+
+def test_normalize_memoized():
+  assert normalize(u'Vinař') == u'vinar'
+  hits = normalize.cache.hits
+  assert normalize(u'Vinař') == u'vinar'
+  assert normalize.cache.hits == hits + 1
+  assert normalize(None) is None
+
+def test_normalized_fields_follow_changes():
+  pub = Publication(u'Some Title', [], 2010)
+  assert pub.norm_title == u'sometitle'
+  pub.title = u'Other Title'
+  assert pub.norm_title == u'othertitle'
+  author = Author(u'Nováková', [u'Jana'])
+  assert author.norm_surname == u'novakova'
+  assert author.norm_first_initial == u'j'
+  assert hash(author) == hash(Author(u'NOVAKOVA'))
+
+def test_publication_dict_roundtrip():
+  pub = Publication(u'Title', [Author(u'Smith', [u'J.'], unparsed_text=u'Smith J.')], 2012,
+    pages=u'1-2', source_urls=[URL(u'http://example.com', type='WOK', description=u'WoS')],
+    identifiers=[Identifier(u'WOS:1', type='WOK')], indexes=[Index(u'SCI', type='WOS')],
+    errors=[u'err'], times_cited=3)
+  d = pub.to_dict()
+  assert Publication.from_dict(d).to_dict() == d
+  assert not hasattr(pub, '__dict__')
+  assert not hasattr(pub.authors[0], '__dict__')
+  assert Index(u'SCI', type=u'WOS').value is Index(u'SCI', type=u'WOS').value
+
+def test_codec_roundtrip_and_legacy_json():
+  pubs = [
+    Publication(u'Vinař', [Author(u'Smith', [u'J.'])], 2012, identifiers=[Identifier(u'WOS:1', type='WOK')]),
+    Publication(u'Other', [], None, authors_incomplete=True, errors=[u'err']),
+  ]
+  expected = [pub.to_dict() for pub in pubs]
+  for c in [codec.JSONCodec(), codec.MarshalCodec(compression=None), codec.MarshalCodec()]:
+    assert [pub.to_dict() for pub in c.loads(c.dumps(pubs))] == expected
+  legacy = json.dumps(expected, sort_keys=True)
+  assert [pub.to_dict() for pub in codec.MarshalCodec().loads(legacy)] == expected
+
+class FakeClock(object):
+  """Hodiny, ktore sa posuvaju len pri sleep a o milisekundu pri kazdom citani"""
+  def __init__(self):
+    self.now = 0.0
+    self.sleeps = []
+  
+  def __call__(self):
+    self.now += 0.001
+    return self.now
+  
+  def sleep(self, sec):
+    self.sleeps.append(sec)
+    self.now += max(0.1, sec)
+
+def test_codec_unknown_format_is_miss():
+  pubs = [Publication(u'Title', [Author(u'Smith', [u'J.'])], 2011)]
+  data = codec.MarshalCodec().dumps(pubs)
+  unknown = data[:2] + '9' + data[3:]
+  try:
+    codec.load_publications(unknown)
+  except codec.UnknownFormat:
+    pass
+  else:
+    assert False, 'expected UnknownFormat'
+  for c in [codec.MarshalCodec(), codec.JSONCodec()]:
+    assert codec.loads_or_none(c, unknown) is None
+    assert codec.loads_or_none(c, data[:len(data) // 2]) is None
+    assert codec.loads_or_none(c, '[{"title"') is None
+    assert [p.title for p in codec.loads_or_none(c, data)] == [u'Title']
+
+class SavedResponse(object):
+  def __init__(self, name):
+    self.url = 'http://www.scopus.com/results/results.url'
+    with open(os.path.join(os.path.dirname(__file__), 'testdata', name)) as f:
+      self.text = f.read().decode('UTF-8')
+
+def test_parse_fast_matches_html5lib():
+  text = SavedResponse('scopus-results.html').text
+  fast = parse_fast(text)
+  full = parse_full(text)
+  # oba stromy maju elementy v XHTML namespace, libxml2 len nevklada tbody
+  tags = lambda tree: set(e.tag for e in tree.iter() if isinstance(e.tag, basestring))
+  assert tags(fast) ^ tags(full) == set(['{%s}tbody' % XHTML_NAMESPACE])
+  assert fast.getroot().tag == full.getroot().tag == '{%s}html' % XHTML_NAMESPACE
+  title_path = '//{%s}title' % XHTML_NAMESPACE
+  assert fast.find(title_path).text == full.find(title_path).text == u'Scopus - Search results'
+  links_xpath = ".//html:a[starts-with(@href, 'http://www.scopus.com/record/display.url')]"
+  links = lambda tree: [(a.get('href'), a.text) for a in tree.xpath(links_xpath, namespaces=namespaces)]
+  assert len(links(fast)) == 2
+  assert links(fast) == links(full)
+
+def test_html_page_forms_match_html5lib():
+  # formular v tabulke: lxml don dava inputy, html5lib (povodne spravanie) nie
+  response = SavedResponse('scopus-results.html')
+  page = HTMLPage(response)
+  form_path = "//{http://www.w3.org/1999/xhtml}form[@name='SearchResultsForm']"
+  errors_xpath = ".//html:form[@name='SearchResultsForm']//*[contains(concat(' ', normalize-space(@class), ' '), ' errText ')]"
+  
+  def params(form):
+    return [param for inp in HTMLForm(form).inputs for param in inp.to_params()]
+  fast_params = params(parse_fast(response.text).find(form_path))
+  full_params = params(parse_full(response.text).find(form_path))
+  assert fast_params != full_params
+  assert params(page.find(form_path, exact=True)) == full_params
+  assert len(parse_fast(response.text).xpath(errors_xpath, namespaces=namespaces)) == 1
+  assert len(page.xpath(errors_xpath, exact=True)) == 0
+
+def test_html_page_falls_back_to_html5lib():
+  page = HTMLPage(SavedResponse('scopus-results.html'))
+  rows_xpath = ".//html:table/html:tbody/html:tr[@class='dataRow']"
+  # bez required sa prazdny vysledok z lxml berie ako odpoved
+  assert page.xpath(rows_xpath) == []
+  assert page._full is None
+  assert len(page.xpath(rows_xpath, required=True)) == 2
+  assert page._full is not None
+  assert page.find('.//{%s}tbody' % XHTML_NAMESPACE) is not None
+
+SCOPUS_CSV = (
+  '\xef\xbb\xbfAuthors,Title,Year,Source title,Volume,Issue,Art. No.,Page start,Page end,Cited by,DOILink,Publisher,ISSN,ISBN\r\n'
+  '"Brejov\xc3\xa1, B., Vina\xc5\x99, T.",First title,2010,Some Journal,12,3,,1,10,4,'
+  '"10.1000/first""http://www.scopus.com/inward/record.url?eid=2-s2.0-84880000001",Publisher,1234-5678,\r\n'
+  '[No author name available],Second title,2011\r\n'
+  '\r\n'
+)
+
+def test_scopus_parse_csv_skips_blank_lines():
+  conn = ScopusWebConnection.__new__(ScopusWebConnection)
+  chunks = [SCOPUS_CSV[i:i + 7] for i in range(0, len(SCOPUS_CSV), 7)]
+  for lines in [SCOPUS_CSV, iter_lines(chunks)]:
+    pubs = list(conn._parse_csv(lines))
+    assert [(p.title, p.year) for p in pubs] == [(u'First title', 2010), (u'Second title', 2011)]
+    assert [a.surname for a in pubs[0].authors] == [u'Brejov\xe1', u'Vina\u0159']
+    assert pubs[0].pages == u'1-10' and pubs[1].authors == []
+    assert set((i.type, i.value) for i in pubs[0].identifiers) == set([
+      ('SCOPUS', u'2-s2.0-84880000001'), ('ISSN', u'1234-5678'), ('DOI', u'10.1000/first')])
+
+def test_throttler_generator_exit_is_not_failure():
+  t = ThreadingThrottler(10, 1)
+  requests = []
+  def stream():
+    with t(BULK) as request:
+      requests.append(request)
+      yield 1
+      yield 2
+  lines = stream()
+  next(lines)
+  assert requests[0].finished_time is None
+  lines.close()
+  assert requests[0].finished_time is not None
+  assert not requests[0].failed
+
+def test_throttler_period_and_delays():
+  clock = FakeClock()
+  t = ThreadingThrottler(2, 10, min_delay=1, finished_delay=0.5, timeout=60, sleep=clock.sleep, clock=clock)
+  started = []
+  for i in range(5):
+    inst = t()
+    with inst:
+      assert clock.now >= inst.started_time
+      started.append(inst.started_time)
+      clock.now += 0.2
+  # dva requesty za 10s, medzi nimi aspon 1s od zaciatku a 0.5s od konca predosleho
+  assert abs(started[1] - started[0] - 1.0) < 1e-9
+  assert started[2] >= started[0] + 10 and started[3] >= started[2] + 1
+  assert started[4] >= started[2] + 10
+
+def test_throttler_timeout():
+  clock = FakeClock()
+  t = ThreadingThrottler(1, 100, timeout=5, sleep=clock.sleep, clock=clock)
+  t()
+  try:
+    t()
+  except ThrottleTimeout:
+    pass
+  else:
+    assert False, 'expected ThrottleTimeout'
+
+def test_throttler_interactive_before_bulk():
+  t = ThreadingThrottler(1, 0.2, timeout=5)
+  order = []
+  def request(name, priority):
+    with t(priority):
+      order.append(name)
+  t()
+  bulk = threading.Thread(target=request, args=('bulk', BULK))
+  bulk.start()
+  time.sleep(0.05)
+  interactive = threading.Thread(target=request, args=('interactive', INTERACTIVE))
+  interactive.start()
+  bulk.join()
+  interactive.join()
+  assert order == ['interactive', 'bulk']
+
+def test_throttler_adaptive_rate():
+  clock = FakeClock()
+  t = ThreadingThrottler(100, 1, timeout=60, sleep=clock.sleep, clock=clock,
+                         adaptive=AIMD(min_rate=1, max_rate=4, increase=1, decrease=0.5, target_latency=2))
+  for i in range(5):
+    with t():
+      pass
+  assert t.adaptive.rate == 4 and abs(t.min_delay - 0.25) < 1e-9
+  try:
+    with t():
+      raise IOError('upstream error')
+  except IOError:
+    pass
+  assert t.adaptive.rate == 2
+  with t() as request:
+    request.check_status(503)
+  assert t.adaptive.rate == 1
+  with t():
+    clock.now += 3
+  assert t.adaptive.rate == 1 and t.adaptive.failures == 3
+  assert t.info()['rate'] == 1
+
+def test_throttler_is_abstract():
+  try:
+    Throttler(1, 1)
+  except TypeError:
+    pass
+  else:
+    assert False, 'expected TypeError'
+
+def throttled_starts(throttler, clock, count):
+  started = []
+  for i in range(count):
+    with throttler() as inst:
+      started.append(inst.started_time)
+      clock.now += 0.2
+  return started
+
+def test_redis_throttler_matches_threading_throttler():
+  try:
+    import fakeredis
+    redis = fakeredis.FakeStrictRedis()
+    redis.register_script('return 1')()
+  except Exception:
+    raise SkipTest('fakeredis with Lua support is not available')
+  kwargs = dict(min_delay=1, finished_delay=0.5, period_delay=0.3, timeout=60)
+  local_clock = FakeClock()
+  local = ThreadingThrottler(2, 10, sleep=local_clock.sleep, clock=local_clock, **kwargs)
+  redis_clock = FakeClock()
+  shared = RedisThrottler(redis, 'test', 2, 10, sleep=redis_clock.sleep, clock=redis_clock, **kwargs)
+  expected = throttled_starts(local, local_clock, 6)
+  started = throttled_starts(shared, redis_clock, 6)
+  # lua skript musi rozostupit requesty rovnako ako historia v pamati
+  assert all(abs(a - b) < 1e-6 for a, b in zip(expected, started)), (expected, started)
+  assert started[2] >= started[0] + 10.3 - 1e-6
+  # druhy throttler s rovnakym klucom vidi tu istu historiu
+  other = RedisThrottler(redis, 'test', 2, 10, sleep=redis_clock.sleep, clock=redis_clock, **kwargs)
+  with other() as inst:
+    assert inst.started_time >= started[-1] + 1
+
+def reference_duplicates(publications):
+  cit = list(publications)
+  buckets = []
+  while len(cit) > 0:
+    cur = cit.pop(0)
+    bucket = [cur]
+    for i in xrange(len(cit) - 1, -1, -1):
+      if cit[i] == cur:
+        bucket.append(cit[i])
+        del cit[i]
+    buckets.append(bucket)
+  return buckets
+
+def test_find_duplicates():
+  smith = Author(u'Smith', [u'J.'])
+  pubs = [
+    Publication(u'Some Title', [smith], 2010, pages=u'1-10'),
+    Publication(u'SOME TITLE', [smith], 2010, pages=u'1-10'),
+    Publication(u'Some title', [], 2010, pages=u'1-10', authors_incomplete=True),
+    Publication(u'Some Title', [smith], 2010, pages=u'11-20'),
+    Publication(u'Some Title', [smith], 2011, pages=u'1-10'),
+    Publication(u'Other Title', [Author(u'Novak', [u'A.'])], 2010),
+    Publication(u'Other Title', [Author(u'Novák', [u'Adam'])], 2010),
+    Publication(u'Some Title', [Author(u'Doe')], 2010, pages=u'1-10'),
+  ]
+  expected = [[id(p) for p in b] for b in reference_duplicates(pubs)]
+  assert [[id(p) for p in b] for b in find_duplicates(pubs)] == expected
+  assert len(expected) == 4
+
+class StaticSource(DataSource, DataSourceConnection):
+  def __init__(self, key, pubs=None, delay=0, error=None):
+    self.key = key
+    self.pubs = pubs or []
+    self.delay = delay
+    self.error = error
+  
+  def connect(self):
+    return self
+  
+  def _result(self):
+    time.sleep(self.delay)
+    if self.error:
+      raise self.error
+    return list(self.pubs)
+  
+  def search_by_author(self, surname, name=None, year=None):
+    return self._result()
+  
+  def search_citations(self, publications):
+    return self._result()
+  
+  def assign_indexes(self, publications):
+    self._result()
+  
+  def close(self):
+    pass
+
+def test_search_citations_by_publication_default():
+  class HandleSource(StaticSource):
+    def can_search_citations(self, publication):
+      return publication.title != u'No handle'
+  source = HandleSource('S', [Publication(u'Citing', [], 2012)])
+  pubs = [Publication(u'Cited', [], 2010), Publication(u'No handle', [], 2010)]
+  results = source.search_citations_by_publication(pubs)
+  assert [p.title for p in results[0]] == [u'Citing']
+  assert results[1] is None
+
+def test_citations_by_publication_copies_repeats():
+  cited = Publication(u'Citing', [], 2012)
+  results = citations_by_publication(['A', None, 'A', 'B'], {'A': [cited], 'B': []})
+  assert results[0][0] is cited and results[1] is None and results[3] == []
+  assert results[2][0] is not cited and results[2][0].title == u'Citing'
+
+class ListPool(object):
+  def __init__(self):
+    self.checked_out = []
+    self.checked_in = []
+  
+  def checkout(self):
+    session = object()
+    self.checked_out.append(session)
+    return session
+  
+  def checkin(self, session):
+    self.checked_in.append(session)
+
+def test_thread_sessions_released_by_workers():
+  pool = ListPool()
+  sessions = ThreadSessions(pool)
+  main = sessions.get()
+  assert sessions.get() is main
+  def worker():
+    sessions.get()
+    sessions.release()
+  for i in range(3):
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+  assert len(pool.checked_out) == 4 and pool.checked_in == pool.checked_out[1:]
+  sessions.close()
+  assert pool.checked_in[-1] is main
+  assert sessions.get() is not main
+
+def test_merge_concurrent_partial_results():
+  fast = StaticSource('FAST', [Publication(u'Fast', [], 2010)])
+  slow = StaticSource('SLOW', [Publication(u'Slow', [], 2010)], delay=0.2)
+  broken = StaticSource('BROKEN', error=IOError('boom'))
+  start = time.time()
+  with Merge(slow, fast, broken, timeout=0.1)() as conn:
+    pubs = conn.search_by_author(u'Smith')
+  assert time.time() - start < 0.2
+  assert [p.title for p in pubs] == [u'Fast']
+  assert len(pubs[0].errors) == 2
+  assert any(u'SLOW' in e for e in pubs[0].errors)
+  assert any(u'BROKEN' in e and u'boom' in e for e in pubs[0].errors)
+
+def test_merge_concurrent_overlaps_sources():
+  sources = [StaticSource(str(i), [Publication(u'Pub {}'.format(i), [], 2010)], delay=0.1) for i in range(3)]
+  start = time.time()
+  with Merge(*sources)() as conn:
+    pubs = conn.search_by_author(u'Smith')
+  assert time.time() - start < 0.25
+  assert [p.title for p in pubs] == [u'Pub 0', u'Pub 1', u'Pub 2']
+
+def test_merge_batches_in_completion_order():
+  slow = StaticSource('SLOW', [Publication(u'Slow', [], 2010)], delay=0.1)
+  fast = StaticSource('FAST', [Publication(u'Fast', [], 2010)])
+  broken = StaticSource('BROKEN', error=IOError('boom'))
+  with Merge(slow, fast, broken)() as conn:
+    batches = list(conn.search_by_author_batches(u'Smith'))
+  assert [b.name for b in batches][-1] == 'SLOW'
+  assert [b.is_error for b in batches if b.name == 'BROKEN'] == [True]
+  assert [p.title for b in batches if b.name == 'FAST' for p in b.result] == [u'Fast']
+
+def test_merge_all_sources_failed():
+  with Merge(StaticSource('BROKEN', error=IOError('boom')))() as conn:
+    try:
+      conn.search_citations([])
+    except IOError:
+      pass
+    else:
+      assert False, 'expected IOError'
+
+def test_merge_failure_with_empty_results():
+  with Merge(StaticSource('EMPTY'), StaticSource('BROKEN', error=IOError('boom')))() as conn:
+    try:
+      conn.search_by_author(u'Smith')
+    except IOError:
+      pass
+    else:
+      assert False, 'expected IOError'
+
 if __name__ == "__main__":
   import nose
   nose.main()
\ No newline at end of file
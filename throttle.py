@@ -2,21 +2,29 @@
 import time
 import threading
 import logging
+import uuid
+import heapq
+from abc import ABCMeta, abstractmethod
+from collections import deque, OrderedDict
 
 logger = logging.getLogger('citacie.throttle')
 
-def max_or_none(seq):
-  if len(seq) == 0:
-    return None
-  return max(seq)
+# priority requestov, mensie cislo ide skor
+INTERACTIVE = 0
+BULK = 1
+
+# ako dlho najmenej pockat pred dalsim pokusom o ziskanie zdroja
+MIN_RETRY_DELAY = 0.001
 
 class ThrottleInstance(object):
-  def __init__(self, throttler, started_time=None):
+  def __init__(self, throttler, started_time=None, id=None):
     if started_time == None:
       started_time = time.time()
     self.started_time = started_time
     self.finished_time = None
     self.throttler = throttler
+    self.id = id
+    self.failed = False
   
   def started_before(self, timestamp):
     return self.started_time < timestamp
@@ -26,10 +34,28 @@ class ThrottleInstance(object):
       return False
     return self.finished_time < timestamp
   
+  def fail(self):
+    """Oznaci request ako neuspesny (pre adaptivny throttling)"""
+    self.failed = True
+  
+  def check_status(self, status_code):
+    """Oznaci request ako neuspesny, ak server vratil chybu alebo nas brzdi"""
+    if status_code == 429 or status_code >= 500:
+      self.fail()
+  
+  @property
+  def latency(self):
+    if self.finished_time == None:
+      return None
+    return self.finished_time - self.started_time
+  
   def __enter__(self):
-    pass
+    return self
   
   def __exit__(self, type, value, traceback):
+    # GeneratorExit znamena, ze volajuci prestal citat odpoved, nie chybu servera
+    if type is not None and not issubclass(type, GeneratorExit):
+      self.fail()
     self.throttler.finished(self)
     return False
   
@@ -39,8 +65,62 @@ class ThrottleInstance(object):
   def __str__(self):
     return repr(self)
 
-class ThreadingThrottler(object):
-  def __init__(self, number, period, min_delay=0, finished_delay=0, period_delay=0, timeout=None, sleep=None):
+class AIMD(object):
+  """Adaptivna rychlost requestov: kym server odpoveda rychlo a bez chyb,
+     rychlost rastie o increase requestov za sekundu, pri chybe alebo
+     pomalej odpovedi sa vynasobi decrease.
+  """
+  def __init__(self, min_rate, max_rate, initial_rate=None, increase=0.1, decrease=0.5, target_latency=5):
+    """
+    min_rate, max_rate - hranice rychlosti (requestov za sekundu)
+    initial_rate - pociatocna rychlost, default min_rate
+    target_latency - odpoved pomalsia ako toto (v sekundach) sa berie ako pretazenie
+    """
+    if not 0 < min_rate <= max_rate:
+      raise ValueError('Expected 0 < min_rate <= max_rate')
+    self.min_rate = min_rate
+    self.max_rate = max_rate
+    if initial_rate == None:
+      initial_rate = min_rate
+    self.rate = min(max(initial_rate, min_rate), max_rate)
+    self.increase = increase
+    self.decrease = decrease
+    self.target_latency = target_latency
+    self.successes = 0
+    self.failures = 0
+    self.last_latency = None
+    self._lock = threading.Lock()
+  
+  def update(self, latency, failed):
+    with self._lock:
+      self.last_latency = latency
+      if failed or (latency != None and latency > self.target_latency):
+        self.failures += 1
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        logger.info('throttle rate decreased to %f (latency %s, failed %s)', self.rate, latency, failed)
+      else:
+        self.successes += 1
+        self.rate = min(self.max_rate, self.rate + self.increase)
+  
+  @property
+  def min_delay(self):
+    return 1.0 / self.rate
+  
+  def info(self):
+    info = OrderedDict()
+    info['adaptive_rate'] = round(self.rate, 3)
+    info['min_rate'] = self.min_rate
+    info['max_rate'] = self.max_rate
+    info['successes'] = self.successes
+    info['failures'] = self.failures
+    if self.last_latency != None:
+      info['last_latency'] = round(self.last_latency, 3)
+    return info
+
+class Throttler(object):
+  __metaclass__ = ABCMeta
+  
+  def __init__(self, number, period, min_delay=0, finished_delay=0, period_delay=0, timeout=None, sleep=None, clock=None, adaptive=None):
     """
     number - pocet requestov
     period - za aku dobu (v sekundach)
@@ -48,6 +128,9 @@ class ThreadingThrottler(object):
     period_delay - kolko cakat po skonceni periody (v sekundach)
     finished_delay - kolko cakat po skonceni requestu
     timeout - kolko maximalne cakat nez sa podari ziskat zdroj
+    adaptive - AIMD, ktore podla odoziev a chyb meni min_delay;
+               number/period potom ostavaju ako horny limit
+    sleep, clock - nahrada za time.sleep a time.time (pre testy)
     """
     self.number = number
     self.period = period
@@ -55,84 +138,271 @@ class ThreadingThrottler(object):
     self.finished_delay = finished_delay
     self.period_delay = period_delay
     self.timeout = timeout
-    self.history = [] # pole timestampov
     if sleep == None:
-      def minsleep(sec):
-        return time.sleep(max(0.1, sec))
-      sleep = minsleep
+      sleep = time.sleep
     self._sleep = sleep
-    self._lock = threading.Lock()
+    if clock == None:
+      clock = time.time
+    self._clock = clock
+    # cakajuci (priorita, poradie); zdroj smie skusat ziskat len prvy z nich,
+    # ostatni spia na self._waiters, kym ich niekto nezobudi
+    self._queue = []
+    self._queue_seq = 0
+    self._waiters = threading.Condition()
+    self.adaptive = adaptive
+    if adaptive != None:
+      self.min_delay = adaptive.min_delay
+  
+  @abstractmethod
+  def _acquire(self):
+    """Skusi zabrat miesto v historii, vrati (ThrottleInstance, wait_until),
+       kde wait_until je cas, kedy moze request zacat (alebo None, ak hned).
+       Ak miesto nie je, vrati (None, wait_until), kedy to ma skusit znova.
+    """
+    raise NotImplementedError
+  
+  def _wait_for_turn(self, ticket, deadline):
+    with self._waiters:
+      while self._queue[0] != ticket:
+        if deadline == None:
+          self._waiters.wait()
+        else:
+          remaining = deadline - self._clock()
+          if remaining <= 0:
+            raise ThrottleTimeout()
+          self._waiters.wait(remaining)
   
-  def throttle(self):
-    wait_until = None
+  def _leave_queue(self, ticket):
+    with self._waiters:
+      self._queue.remove(ticket)
+      heapq.heapify(self._queue)
+      self._waiters.notify_all()
+  
+  def throttle(self, priority=INTERACTIVE):
+    """Pocka, kym moze zacat dalsi request a vrati jeho ThrottleInstance.
+       Cakajuci sa obsluhuju podla priority (INTERACTIVE pred BULK),
+       v ramci rovnakej priority v poradi prichodu.
+    """
     if self.timeout:
-      deadline = time.time() + self.timeout
+      deadline = self._clock() + self.timeout
     else:
       deadline = None
-    timed_out = True
-    result = None
-    while deadline == None or time.time() < deadline:
-      if wait_until:
-        if wait_until > deadline:
+    with self._waiters:
+      ticket = (priority, self._queue_seq)
+      self._queue_seq += 1
+      heapq.heappush(self._queue, ticket)
+    try:
+      while True:
+        self._wait_for_turn(ticket, deadline)
+        if deadline != None and self._clock() >= deadline:
+          raise ThrottleTimeout()
+        result, wait_until = self._acquire()
+        if result is not None:
           break
-        delay = wait_until - time.time()
-        logger.debug('calculated delay %f', delay)
-        if delay > 0:
-          logger.debug('throttle sleep for %f seconds', delay)
-          self._sleep(delay)
-        wait_until = None
-      with self._lock:
-        now = time.time()
-        
-        # zahodime staru historiu
-        while len(self.history) > 0 and self.history[0].started_before(now - self.period):
-          logger.debug('popping history item from %f', self.history[0].started_time)
-          self.history.pop(0)
-        
-        max_finished = max_or_none([x.finished_time for x in self.history if x != None])
-        max_started = max_or_none([x.started_time for x in self.history if x != None])
-        
-        if len(self.history) == self.number:
-          min_started = self.history[0].started_time
-          # musime pockat do skoncenia periody
-          wait_until = max(min_started + self.period + self.period_delay, max_started + self.min_delay)
-          if max_finished:
-            wait_until = max(wait_until, max_finished + self.finished_delay)
-          logger.debug('period used %s, waiting until %f', str(self.history), wait_until)
-          continue
-        
-        # kolko treba pockat medzi requestami
-        if len(self.history):
-          wait_until = max_started + self.min_delay
-          if max_finished:
-            wait_until = max(wait_until, max_finished + self.finished_delay)
-          our_request = max(wait_until, now)
-        else:
-          wait_until = None
-          our_request = now
-        
-        result = ThrottleInstance(self, our_request)
-        self.history.append(result)
-        logger.debug('adding to history %f', our_request)
-        timed_out = False
-        break
-    if timed_out:
-      raise ThrottleTimeout()
+        if deadline != None and wait_until > deadline:
+          raise ThrottleTimeout()
+        # ak medzicasom pride dolezitejsi request, po zobudeni uz nebudeme prvi
+        delay = max(wait_until - self._clock(), MIN_RETRY_DELAY)
+        logger.debug('throttle sleep for %f seconds', delay)
+        self._sleep(delay)
+    finally:
+      self._leave_queue(ticket)
     if wait_until:
-      delay = wait_until - time.time()
+      delay = wait_until - self._clock()
       if delay > 0:
         logger.debug('throttle final sleep for %f seconds', delay)
         self._sleep(delay)
-      wait_until = None
     logger.debug('throttle finished')
     return result
   
+  @abstractmethod
+  def _finished(self, inst):
+    """Zaznamena koniec requestu do historie"""
+    raise NotImplementedError
+  
   def finished(self, inst):
+    inst.finished_time = self._clock()
+    self._finished(inst)
+    if self.adaptive != None:
+      self.adaptive.update(inst.latency, inst.failed)
+      self.min_delay = self.adaptive.min_delay
+  
+  @property
+  def rate(self):
+    """Maximalny pocet requestov za sekundu pri aktualnych nastaveniach"""
+    rate = float(self.number) / self.period
+    if self.min_delay > 0:
+      rate = min(rate, 1.0 / self.min_delay)
+    return rate
+  
+  def info(self):
+    info = OrderedDict()
+    info['rate'] = round(self.rate, 3)
+    info['number'] = self.number
+    info['period'] = self.period
+    info['min_delay'] = round(self.min_delay, 3)
+    if self.adaptive != None:
+      info.update(self.adaptive.info())
+    return info
+  
+  def __call__(self, priority=INTERACTIVE):
+    return self.throttle(priority)
+
+class ThreadingThrottler(Throttler):
+  """Throttler, ktory si historiu drzi v pamati, plati teda len v ramci procesu"""
+  def __init__(self, *args, **kwargs):
+    super(ThreadingThrottler, self).__init__(*args, **kwargs)
+    # zaciatky requestov su neklesajuce, takze historia je zoradena podla
+    # started_time a najnovsi zaciatok je vzdy na konci
+    self.history = deque()
+    # konce requestov ako max-heap (-finished_time, id), polozky z uz
+    # zahodenej historie (id < history[0].id) odstranujeme lenivo
+    self._finished_heap = []
+    self._next_id = 0
+    self._lock = threading.Lock()
+  
+  def _max_finished(self):
+    if len(self.history) == 0:
+      return None
+    first_id = self.history[0].id
+    while self._finished_heap and self._finished_heap[0][1] < first_id:
+      heapq.heappop(self._finished_heap)
+    if not self._finished_heap:
+      return None
+    return -self._finished_heap[0][0]
+  
+  def _acquire(self):
     with self._lock:
-      inst.finished_time = time.time()
+      now = self._clock()
+      
+      # zahodime staru historiu
+      while len(self.history) > 0 and self.history[0].started_before(now - self.period):
+        logger.debug('popping history item from %f', self.history[0].started_time)
+        self.history.popleft()
+      
+      max_finished = self._max_finished()
+      
+      if len(self.history) >= self.number:
+        min_started = self.history[0].started_time
+        max_started = self.history[-1].started_time
+        # musime pockat do skoncenia periody
+        wait_until = max(min_started + self.period + self.period_delay, max_started + self.min_delay)
+        if max_finished:
+          wait_until = max(wait_until, max_finished + self.finished_delay)
+        logger.debug('period used %s, waiting until %f', str(self.history), wait_until)
+        return None, wait_until
+      
+      # kolko treba pockat medzi requestami
+      if len(self.history):
+        wait_until = self.history[-1].started_time + self.min_delay
+        if max_finished:
+          wait_until = max(wait_until, max_finished + self.finished_delay)
+        our_request = max(wait_until, now)
+      else:
+        wait_until = None
+        our_request = now
+      
+      result = ThrottleInstance(self, our_request, id=self._next_id)
+      self._next_id += 1
+      self.history.append(result)
+      logger.debug('adding to history %f', our_request)
+      return result, wait_until
+  
+  def _finished(self, inst):
+    with self._lock:
+      heapq.heappush(self._finished_heap, (-inst.finished_time, inst.id))
+      # zahodene polozky, ktore lenivo nevyplavali navrch, obcas vycistime
+      if len(self._finished_heap) > 2 * len(self.history) + 16:
+        first_id = self.history[0].id if self.history else self._next_id
+        self._finished_heap = [x for x in self._finished_heap if x[1] >= first_id]
+        heapq.heapify(self._finished_heap)
+
+# KEYS: zoznam zaciatkov (zset id -> started), konce (hash id -> finished)
+# ARGV: now, number, period, min_delay, finished_delay, period_delay, id
+# Vracia {1, our_request, wait_until alebo 0} ak sa miesto podarilo zabrat,
+# inak {0, wait_until}. Cisla vraciame ako stringy, inak by ich redis oseknul na cele.
+REDIS_ACQUIRE_SCRIPT = """
+local started_key, finished_key = KEYS[1], KEYS[2]
+local now = tonumber(ARGV[1])
+local number, period = tonumber(ARGV[2]), tonumber(ARGV[3])
+local min_delay, finished_delay, period_delay = tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6])
+local id = ARGV[7]
+
+-- zahodime staru historiu
+local old = redis.call('ZRANGEBYSCORE', started_key, '-inf', '(' .. tostring(now - period))
+for _, old_id in ipairs(old) do
+  redis.call('ZREM', started_key, old_id)
+  redis.call('HDEL', finished_key, old_id)
+end
+
+local count = redis.call('ZCARD', started_key)
+local wait_until = nil
+if count > 0 then
+  local last = redis.call('ZREVRANGE', started_key, 0, 0, 'WITHSCORES')
+  wait_until = tonumber(last[2]) + min_delay
+  local max_finished = nil
+  for _, f in ipairs(redis.call('HVALS', finished_key)) do
+    f = tonumber(f)
+    if max_finished == nil or f > max_finished then
+      max_finished = f
+    end
+  end
+  if max_finished then
+    wait_until = math.max(wait_until, max_finished + finished_delay)
+  end
+  if count >= number then
+    local first = redis.call('ZRANGE', started_key, 0, 0, 'WITHSCORES')
+    wait_until = math.max(wait_until, tonumber(first[2]) + period + period_delay)
+    return {0, tostring(wait_until)}
+  end
+end
+
+local our_request = now
+if wait_until then
+  our_request = math.max(wait_until, now)
+end
+redis.call('ZADD', started_key, our_request, id)
+local ttl = math.ceil(our_request - now + period + period_delay) + 60
+redis.call('EXPIRE', started_key, ttl)
+redis.call('EXPIRE', finished_key, ttl)
+return {1, tostring(our_request), tostring(wait_until or 0)}
+"""
+
+REDIS_FINISHED_SCRIPT = """
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+  redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+end
+"""
+
+class RedisThrottler(Throttler):
+  """Throttler s historiou v redise, zdielany vsetkymi procesmi, ktore pouzivaju
+     rovnaky kluc. Casy sa beru z hodin procesov, tie by mali byt synchronizovane.
+  """
+  def __init__(self, redis, key, *args, **kwargs):
+    super(RedisThrottler, self).__init__(*args, **kwargs)
+    self.redis = redis
+    self.key = key
+    self.started_key = 'citacie:throttle:{}:started'.format(key)
+    self.finished_key = 'citacie:throttle:{}:finished'.format(key)
+    self._acquire_script = redis.register_script(REDIS_ACQUIRE_SCRIPT)
+    self._finished_script = redis.register_script(REDIS_FINISHED_SCRIPT)
+  
+  def _acquire(self):
+    id = uuid.uuid4().hex
+    args = [repr(self._clock()), self.number, repr(float(self.period)), repr(float(self.min_delay)),
+            repr(float(self.finished_delay)), repr(float(self.period_delay)), id]
+    reply = self._acquire_script(keys=[self.started_key, self.finished_key], args=args)
+    if int(reply[0]) == 0:
+      wait_until = float(reply[1])
+      logger.debug('period used in %s, waiting until %f', self.key, wait_until)
+      return None, wait_until
+    our_request = float(reply[1])
+    wait_until = float(reply[2]) or None
+    logger.debug('adding to history of %s %f', self.key, our_request)
+    return ThrottleInstance(self, our_request, id=id), wait_until
   
-  def __call__(self):
-    return self.throttle()
+  def _finished(self, inst):
+    self._finished_script(keys=[self.started_key, self.finished_key], args=[inst.id, repr(inst.finished_time)])
 
 class ThrottleTimeout(BaseException):
   """Vyhodene ked sa po dlhy cas nepodari ziskat throttle zamok"""
@@ -3,12 +3,33 @@ import codecs
 import unicodedata
 import string
 import re
+import threading
+import time
+from collections import OrderedDict
 
 def strip_bom(bytestr):
   if bytestr.startswith(codecs.BOM_UTF8):
     return bytestr[len(codecs.BOM_UTF8):]
   return bytestr
 
+def iter_lines(chunks):
+  """Rozdeli iterator kusov textu (napr. iter_content) na riadky bez koncov riadkov,
+     rovnako ako splitlines() na ich spojeni, ale bez drzania celeho textu v pamati
+  """
+  pending = ''
+  for chunk in chunks:
+    if pending:
+      chunk = pending + chunk
+    lines = chunk.splitlines(True)
+    # posledny riadok moze pokracovat v dalsom kuse, aj ked konci na \r (moze nasledovat \n)
+    pending = ''
+    if lines and not lines[-1].endswith('\n'):
+      pending = lines.pop()
+    for line in lines:
+      yield line.rstrip('\r\n')
+  if pending:
+    yield pending.rstrip('\r\n')
+
 def make_page_range(begin_page, end_page):
   page_range = []
   if begin_page:
@@ -19,6 +40,156 @@ def make_page_range(begin_page, end_page):
     return None
   return u'-'.join(page_range)
 
+class LRUCache(object):
+  """Ohraniceny slovnik, pri preplneni zahadzuje najdlhsie nepouzite polozky
+  
+     Polozky su v kruhovom spojkovom zozname [prev, next, key, value],
+     OrderedDict je v pythone 2 na toto prilis pomaly
+  """
+  def __init__(self, maxsize):
+    self.maxsize = maxsize
+    self.hits = 0
+    self.misses = 0
+    self._data = {}
+    self._root = []
+    self._root[:] = [self._root, self._root, None, None]
+    self._lock = threading.Lock()
+  
+  def get(self, key, default=None):
+    with self._lock:
+      link = self._data.get(key)
+      if link is None:
+        self.misses += 1
+        return default
+      # presunieme na koniec (najnovsie)
+      prev, next = link[0], link[1]
+      prev[1] = next
+      next[0] = prev
+      root = self._root
+      last = root[0]
+      last[1] = root[0] = link
+      link[0] = last
+      link[1] = root
+      self.hits += 1
+      return link[3]
+  
+  def put(self, key, value):
+    with self._lock:
+      root = self._root
+      link = self._data.pop(key, None)
+      if link is not None:
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+      elif len(self._data) >= self.maxsize:
+        oldest = root[1]
+        root[1] = oldest[1]
+        oldest[1][0] = root
+        del self._data[oldest[2]]
+      last = root[0]
+      link = [last, root, key, value]
+      last[1] = root[0] = self._data[key] = link
+  
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+      self._root[:] = [self._root, self._root, None, None]
+      self.hits = 0
+      self.misses = 0
+  
+  def __len__(self):
+    return len(self._data)
+  
+  def info(self):
+    total = self.hits + self.misses
+    return OrderedDict([
+      ('hits', self.hits), ('misses', self.misses),
+      ('hit_rate', float(self.hits) / total if total else None),
+      ('size', len(self._data)), ('maxsize', self.maxsize),
+    ])
+
+class SizedTTLCache(object):
+  """LRU cache ohranicena suctom velkosti poloziek (napr. v bajtoch),
+     polozky navyse expiruju po ttl sekundach
+  """
+  def __init__(self, max_size, ttl, clock=None):
+    self.max_size = max_size
+    self.ttl = ttl
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    if clock == None:
+      clock = time.time
+    self._clock = clock
+    self._data = OrderedDict() # key -> (value, size, expires)
+    self._lock = threading.Lock()
+  
+  def _remove(self, key):
+    value, size, expires = self._data.pop(key)
+    self.size -= size
+  
+  def get(self, key, default=None):
+    with self._lock:
+      entry = self._data.get(key)
+      if entry is None:
+        self.misses += 1
+        return default
+      if entry[2] <= self._clock():
+        self._remove(key)
+        self.misses += 1
+        return default
+      del self._data[key]
+      self._data[key] = entry
+      self.hits += 1
+      return entry[0]
+  
+  def put(self, key, value, size):
+    with self._lock:
+      if key in self._data:
+        self._remove(key)
+      if size > self.max_size:
+        return
+      self._data[key] = (value, size, self._clock() + self.ttl)
+      self.size += size
+      while self.size > self.max_size:
+        self._remove(next(iter(self._data)))
+        self.evictions += 1
+  
+  def discard(self, key):
+    with self._lock:
+      if key in self._data:
+        self._remove(key)
+  
+  def __len__(self):
+    return len(self._data)
+  
+  def info(self):
+    total = self.hits + self.misses
+    return OrderedDict([
+      ('hits', self.hits), ('misses', self.misses),
+      ('hit_rate', float(self.hits) / total if total else None),
+      ('evictions', self.evictions), ('entries', len(self._data)),
+      ('size', self.size), ('max_size', self.max_size), ('ttl', self.ttl),
+    ])
+
+def memoize(maxsize):
+  """Dekorator pre funkcie jedneho hashovatelneho argumentu, cache je vo fn.cache"""
+  def decorator(fn):
+    cache = LRUCache(maxsize)
+    missing = object()
+    def wrapper(arg):
+      value = cache.get(arg, missing)
+      if value is missing:
+        value = fn(arg)
+        cache.put(arg, value)
+      return value
+    wrapper.cache = cache
+    wrapper.__name__ = fn.__name__
+    wrapper.__doc__ = fn.__doc__
+    return wrapper
+  return decorator
+
+@memoize(maxsize=100000)
 def normalize(unicode_string):
   if unicode_string == None:
     return None
@@ -1,10 +1,10 @@
 # -*- coding: utf-8 -*-
 from suds.client import Client
+from suds.cache import ObjectCache
 from model import Publication, Author, Identifier, URL, Index
 import time
 from xmlbuilder import XMLBuilder
 import types
-import urllib2
 from contextlib import closing
 from defusedxml import ElementTree
 from data_source import DataSource, DataSourceConnection
@@ -14,8 +14,11 @@ import re
 from collections import OrderedDict, namedtuple
 from urllib import urlencode, quote
 import requests
-from util import make_page_range
-from throttle import ThreadingThrottler
+from requests.adapters import HTTPAdapter
+from util import make_page_range, SizedTTLCache, iter_lines
+from sessionpool import SessionPool
+from throttle import ThreadingThrottler, INTERACTIVE, BULK
+from multiprocessing.pool import ThreadPool
 import threading
 import logging
 
@@ -45,21 +48,63 @@ class WokSession(object):
   def __str__(self):
     return '{} {}'.format(self.id, self.created)
 
+class SudsClientPool(object):
+  """Kazde WSDL sa parsuje len raz za proces (a sparsovane sa drzi aj na disku),
+     kazde vlakno dostane vlastny klon klienta, lebo suds klient nie je thread-safe.
+     Medzi sessions sa na klientovi meni len hlavicka so SID.
+  """
+  def __init__(self, cache_dir=None, cache_days=7):
+    """cache_dir - kde drzat sparsovane WSDL a schemy, default adresar suds v tempe"""
+    self.cache_dir = cache_dir
+    self.cache_days = cache_days
+    self._cache = None
+    self._templates = {}
+    self._lock = threading.Lock()
+    self._local = threading.local()
+  
+  def _template(self, wsdl):
+    with self._lock:
+      client = self._templates.get(wsdl)
+      if client == None:
+        if self._cache == None:
+          self._cache = ObjectCache(location=self.cache_dir, days=self.cache_days)
+        client = Client(wsdl, cache=self._cache)
+        self._templates[wsdl] = client
+      return client
+  
+  def client(self, wsdl, sid=None):
+    """Vrati klienta pre aktualne vlakno nastaveneho na session sid (alebo bez session)"""
+    clients = getattr(self._local, 'clients', None)
+    if clients == None:
+      clients = self._local.clients = {}
+    client = clients.get(wsdl)
+    if client == None:
+      client = clients[wsdl] = self._template(wsdl).clone()
+    if sid == None:
+      headers = {}
+    else:
+      headers = {'Cookie': 'SID=' + sid}
+    client.set_options(headers=headers)
+    return client
+
+client_pool = SudsClientPool()
+
 class WokAuthService(object):
-  def __init__(self, throttler=None):
+  def __init__(self, throttler=None, clients=None):
     self.wsdl_auth = 'http://search.webofknowledge.com/esti/wokmws/ws/WOKMWSAuthenticate?wsdl'
-    self.client = Client(self.wsdl_auth)
+    if clients == None:
+      clients = client_pool
+    self.clients = clients
     if throttler == None:
       throttler = ThreadingThrottler(number=5, period=5 * 60, min_delay=1, timeout=5 * 60)
     self.throttler = throttler
   
   def authenticate(self):
-    with self.throttler():
-      return WokSession(self.client.service.authenticate())
+    with self.throttler(INTERACTIVE):
+      return WokSession(self.clients.client(self.wsdl_auth).service.authenticate())
   
   def close_session(self, session):
-    client = Client(self.wsdl_auth, headers={'Cookie': 'SID=' + session.id})
-    return client.service.closeSession()
+    return self.clients.client(self.wsdl_auth, session.id).service.closeSession()
 
 class PoolingWokAuthService(object):
   def __init__(self, real, pool_max=4, timeout=60, session_max_idle=10*60):
@@ -139,26 +184,53 @@ class PoolingWokAuthService(object):
         
 
 class WokWS(DataSource):
-  def __init__(self, throttler=None, auth=None):
+  def __init__(self, throttler=None, auth=None, **options):
+    """options sa posielaju do WokWSConnection:
+       clients - SudsClientPool, default zdielany client_pool
+       page_workers - kolko dalsich stranok vysledkov stahovat naraz (stale cez throttler)
+       page_retries - kolkokrat skusit znova stranku, ktoru sa nepodarilo stiahnut
+       edition_workers - kolko dotazov na edicie (indexy) posielat naraz
+       edition_chunk_size - kolko UT najviac dat do jedneho dotazu na ediciu
+       edition_cache - cache UT -> edicia (napr. redis_integration.RedisEditionCache)
+    """
     if throttler == None:
       throttler = ThreadingThrottler(number=1, period=1, min_delay=1, finished_delay=0.5, timeout=60)
     if auth == None:
       auth = WokAuthService()
     self.throttler = throttler
     self.auth = auth
+    self.options = options
   
   def connect(self):
-    return WokWSConnection(self.throttler, self.auth)
+    return WokWSConnection(self.throttler, self.auth, **self.options)
 
 class WokWSConnection(DataSourceConnection):
-  def __init__(self, throttler, auth):
+  EDITIONS = ['SCI', 'SSCI', 'AHCI', 'ISTP', 'ISSHP', 'BSCI', 'BHCI']
+  EDITION_CAPTION = {'SCI': 'SCI', 'SSCI': 'SSCI', 'AHCI': 'AHCI',
+                     'ISTP': 'CPCI-S', 'ISSHP': 'CPCI-SSH', 'BSCI': 'BKCI-S',
+                     'BHCI': 'BKCI-SSH'}
+  
+  def __init__(self, throttler, auth, page_workers=1, page_retries=2, clients=None,
+               edition_workers=4, edition_chunk_size=50, edition_cache=None):
     self.wsdl_search = 'http://search.webofknowledge.com/esti/wokmws/ws/WokSearchLite?wsdl'
+    if clients == None:
+      clients = client_pool
+    self.clients = clients
     
     self.auth = auth
     self.session = self.auth.authenticate()
-    self.search = Client(self.wsdl_search, headers={'Cookie': 'SID=' + self.session.id})
     
     self.throttler = throttler
+    self.page_workers = page_workers
+    self.page_retries = page_retries
+    self.edition_workers = edition_workers
+    self.edition_chunk_size = edition_chunk_size
+    self.edition_cache = edition_cache
+  
+  @property
+  def search(self):
+    """Klient pre aktualne vlakno nastaveny na session tohto spojenia"""
+    return self.clients.client(self.wsdl_search, self.session.id)
   
   def close(self):
     self.auth.close_session(self.session)
@@ -167,7 +239,7 @@ class WokWSConnection(DataSourceConnection):
     params = self.search.factory.create('retrieveParameters')
     params.firstRecord = 1
     params.count = 2
-    with self.throttler():
+    with self.throttler(INTERACTIVE):
       return self.search.service.retrieveById(databaseId='WOK', uid=uid,
         queryLanguage='en', retrieveParameters=params)
   
@@ -242,7 +314,7 @@ class WokWSConnection(DataSourceConnection):
   def _log_search(self, context, records):
     pass
   
-  def _search(self, query, database_id='WOS', timespan=None, edition=None):
+  def _search(self, query, database_id='WOS', timespan=None, edition=None, priority=INTERACTIVE):
     query_params = self.search.factory.create('queryParameters')
     query_params.databaseId = database_id
     query_params.userQuery = query
@@ -260,10 +332,11 @@ class WokWSConnection(DataSourceConnection):
       ts.end = timespan[1]
       query_params.timeSpan = ts
     
+    page_size = 100
     retr_params = self.search.factory.create('retrieveParameters')
     retr_params.firstRecord = 1
-    retr_params.count = 100
-    with self.throttler():
+    retr_params.count = page_size
+    with self.throttler(priority):
       first_result = self.search.service.search(query_params, retr_params)
     
     if first_result.recordsFound == 0:
@@ -271,18 +344,12 @@ class WokWSConnection(DataSourceConnection):
       return []
     
     records = []
-    pages = first_result.recordsFound / retr_params.count
-    if first_result.recordsFound % retr_params.count > 0:
-      pages += 1
-    
     records.extend(first_result.records)
-        
+    
     # retrieve additional records
-    for pagenum in range(1, pages):
-      retr_params.firstRecord += retr_params.count
-      with self.throttler():
-        additional_result = self.search.service.retrieve(first_result.queryId, retr_params)
-      records.extend(additional_result.records)
+    additional = list(pages(first_result.recordsFound - page_size, page_size, start_index=page_size + 1))
+    for page_records in self._retrieve_pages(first_result.queryId, additional, priority):
+      records.extend(page_records)
     
     if len(records) < first_result.recordsFound:
       raise ValueError('Failed retrieving all results')
@@ -290,6 +357,42 @@ class WokWSConnection(DataSourceConnection):
     self._log_search(['_search', query, database_id, timespan, edition], records)
     return records
   
+  def _retrieve_page(self, query_id, page, priority):
+    client = self.search
+    retr_params = client.factory.create('retrieveParameters')
+    retr_params.firstRecord = page.start_index
+    retr_params.count = page.count
+    attempt = 0
+    while True:
+      try:
+        with self.throttler(priority):
+          return client.service.retrieve(query_id, retr_params).records
+      except Exception:
+        if attempt >= self.page_retries:
+          raise
+        attempt += 1
+        logger.warning('Retrying page from %d of query %s (attempt %d)', page.start_index, query_id, attempt, exc_info=True)
+  
+  def _map(self, fn, items, workers):
+    """Ako map(fn, items), ale v najviac workers vlaknach naraz.
+       Kazde vlakno dostane od self.clients vlastneho klienta.
+    """
+    workers = min(workers, len(items))
+    if workers <= 1:
+      return [fn(item) for item in items]
+    pool = ThreadPool(workers)
+    try:
+      return pool.map(fn, items)
+    finally:
+      pool.close()
+      pool.join()
+  
+  def _retrieve_pages(self, query_id, page_list, priority):
+    """Stiahne stranky vysledkov, vrati zoznam zaznamov pre kazdu stranku v poradi page_list"""
+    def retrieve(page):
+      return self._retrieve_page(query_id, page, priority)
+    return self._map(retrieve, page_list, self.page_workers)
+  
   def search_by_author(self, surname, name=None, year=None):
     # TODO escaping
     query = u'AU=('
@@ -304,23 +407,44 @@ class WokWSConnection(DataSourceConnection):
   def search_citations(self, publications):
     raise NotImplemented # sluzba nepodporuje
   
+  def _probe_editions(self, uts):
+    """Zisti edicie pre UT dotazmi na kazdu ediciu po kuskoch najviac edition_chunk_size UT.
+       Edicie sa skusaju postupne podla poradia v EDITIONS a UT najdene v jednej
+       sa v dalsich uz nehladaju, paralelne idu len kusky v ramci edicie.
+    """
+    unknown = list(uts)
+    utmap = {}
+    for edition in self.EDITIONS:
+      if len(unknown) == 0:
+        break
+      chunks = [unknown[i:i + self.edition_chunk_size] for i in range(0, len(unknown), self.edition_chunk_size)]
+      
+      def probe(chunk, edition=edition):
+        query = u'UT=({})'.format(u' OR '.join(chunk))
+        return [unicode(record.uid) for record in self._search(query, edition=edition, priority=BULK)]
+      
+      for found in self._map(probe, chunks, self.edition_workers):
+        for ut in found:
+          utmap[ut] = self.EDITION_CAPTION[edition]
+      unknown = [ut for ut in unknown if ut not in utmap]
+    return utmap
+  
   def _find_editions(self, uts):
-    try_editions = ['SCI', 'SSCI', 'AHCI', 'ISTP', 'ISSHP', 'BSCI', 'BHCI']
-    edition_caption = {'SCI': 'SCI', 'SSCI': 'SSCI', 'AHCI': 'AHCI',
-                       'ISTP': 'CPCI-S', 'ISSHP': 'CPCI-SSH', 'BSCI': 'BKCI-S',
-                       'BHCI': 'BKCI-SSH'}
-    
     unknown = set(uts)
     utmap = {}
     
-    for edition in try_editions:
-      if len(unknown) == 0:
-        break
-      query = u'UT=({})'.format(u' OR '.join(ut for ut in unknown))
-      for record in self._search(query, edition=edition):
-        record_uid = unicode(record.uid)
-        utmap[record_uid] = edition_caption[edition]
-        unknown.remove(record_uid)
+    if self.edition_cache != None and len(unknown) > 0:
+      for ut, edition in self.edition_cache.get_many(unknown).iteritems():
+        # prazdna edicia znamena, ze UT uz sme hladali a nie je v ziadnej
+        if edition:
+          utmap[ut] = edition
+        unknown.discard(ut)
+    
+    if len(unknown) > 0:
+      found = self._probe_editions(sorted(unknown))
+      utmap.update(found)
+      if self.edition_cache != None:
+        self.edition_cache.set_many(dict((ut, found.get(ut, u'')) for ut in unknown))
     
     return utmap
   
@@ -344,11 +468,27 @@ class WokWSConnection(DataSourceConnection):
       pub_by_id[ut].indexes.append(Index(edition, type='WOS'))
 
 class LAMR:
-  def __init__(self, throttler=None):
+  fields = ['timesCited', 'sourceURL', 'citingArticlesURL']
+  
+  def __init__(self, throttler=None, workers=4, cache_size=10000, cache_ttl=10*60):
+    """workers - kolko davok po 50 UID posielat naraz (stale cez throttler)
+       cache_size, cache_ttl - kolko vysledkov (po UID) a na kolko sekund si pamatat,
+                               cache_size=0 cache vypne
+    """
     self.post_url = 'https://ws.isiknowledge.com/cps/xrpc'
     if throttler == None:
       throttler = ThreadingThrottler(number=1, period=1, min_delay=1, timeout=60)
     self.throttler = throttler
+    self.workers = workers
+    # spojenia sa drzia otvorene (keep-alive), pre kazdeho workera jedno
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=max(workers, 1))
+    self.session.mount('https://', adapter)
+    self.session.mount('http://', adapter)
+    if cache_size > 0:
+      self.cache = SizedTTLCache(cache_size, cache_ttl)
+    else:
+      self.cache = None
   
   def _build_retrieve_request(self, fields, uids):
     x = XMLBuilder('request', xmlns='http://www.isinet.com/xrpc42')
@@ -382,33 +522,58 @@ class LAMR:
     return results
   
   def _retrieve(self, fields, uids):
-    with self.throttler():
-      req_body = self._build_retrieve_request(fields, uids)
-      with closing(urllib2.urlopen(self.post_url, req_body)) as f:
-        response = f.read()
-      parsed_response = self._parse_retrieve_response(response)
-      response_by_uid = {}
-      for i, uid in enumerate(uids):
-        key = 'cite{}'.format(i)
-        if key not in parsed_response:
-          continue
-        response_by_uid[uid] = parsed_response[key]
-      return response_by_uid
+    req_body = self._build_retrieve_request(fields, uids)
+    with self.throttler(INTERACTIVE) as request:
+      r = self.session.post(self.post_url, data=req_body)
+      request.check_status(r.status_code)
+    r.raise_for_status()
+    parsed_response = self._parse_retrieve_response(r.content)
+    response_by_uid = {}
+    for i, uid in enumerate(uids):
+      key = 'cite{}'.format(i)
+      if key not in parsed_response:
+        continue
+      response_by_uid[uid] = parsed_response[key]
+    return response_by_uid
 
   def retrieve_by_ids(self, uids):
+    results = {}
+    missing = []
+    for uid in uids:
+      cached = self.cache.get(uid) if self.cache != None else None
+      if cached != None:
+        results[uid] = cached
+      else:
+        missing.append(uid)
+    
     # split into requests of max 50
     pagesize = 50
-    pages = len(uids) / pagesize
-    if len(uids) % pagesize > 0:
-      pages += 1
-    results = {}
-    for page in range(pages):
-      sublist = uids[page * pagesize:min((page + 1) * pagesize, len(uids))]
-      results.update(self._retrieve(['timesCited', 'sourceURL', 'citingArticlesURL'], sublist))
+    sublists = [missing[i:i + pagesize] for i in range(0, len(missing), pagesize)]
+    def retrieve(sublist):
+      return self._retrieve(self.fields, sublist)
+    workers = min(self.workers, len(sublists))
+    if workers <= 1:
+      responses = [retrieve(sublist) for sublist in sublists]
+    else:
+      pool = ThreadPool(workers)
+      try:
+        responses = pool.map(retrieve, sublists)
+      finally:
+        pool.close()
+        pool.join()
+    
+    for response in responses:
+      for uid, result in response.iteritems():
+        if self.cache != None:
+          self.cache.put(uid, result, 1)
+        results[uid] = result
     return results
 
 class WokWeb(DataSource):
-  def __init__(self, additional_headers=None, throttler=None):
+  def __init__(self, additional_headers=None, throttler=None, export_workers=1, sessions=None):
+    """export_workers - kolko rozsahov citacii exportovat naraz (stale cez throttler)
+       sessions - SessionPool zdielany vsetkymi connections, default s additional_headers
+    """
     self.url = 'http://apps.webofknowledge.com/'
     #self.url = 'http://localhost:8000/'
     if additional_headers == None:
@@ -417,17 +582,24 @@ class WokWeb(DataSource):
     if throttler == None:
       throttler = ThreadingThrottler(number=1, period=1, min_delay=1, finished_delay=0.5, timeout=60)
     self.throttler = throttler
+    self.export_workers = export_workers
+    if sessions == None:
+      sessions = SessionPool(headers=additional_headers)
+    self.sessions = sessions
     
   def connect(self):
-    return WokWebConnection(self.url, self.throttler, additional_headers=self.additional_headers)
+    return WokWebConnection(self.url, self.throttler, additional_headers=self.additional_headers,
+                            export_workers=self.export_workers, sessions=self.sessions)
   
 class WokWebConnection(DataSourceConnection):
-  def __init__(self, url, throttler, additional_headers=None):
+  def __init__(self, url, throttler, additional_headers=None, export_workers=1, sessions=None):
     self.url = url
+    self.export_workers = export_workers
     self.additional_headers = additional_headers
-    self.session = requests.Session()
-    if additional_headers:
-      self.session.headers.update(additional_headers)
+    if sessions == None:
+      sessions = SessionPool(max_idle_sessions=0, headers=additional_headers)
+    self.sessions = sessions
+    self.session = sessions.checkout()
     self.throttler = throttler
   
   def _strip(self, e):
@@ -526,7 +698,7 @@ class WokWebConnection(DataSourceConnection):
     if name:
       fname += ' {}*'.format(name)
     self.browser['value(input2)'] = str(fname)
-    with self.throttler():
+    with self.throttler(INTERACTIVE):
       r = self.browser.submit()
     print r.get_data()
     
@@ -540,61 +712,110 @@ class WokWebConnection(DataSourceConnection):
   def _get_sid(self):
     return self.session.cookies['SID'].strip('"')
   
+  # ci _log_tab_delimited nieco robi, inak sa export nemusi drzat cely v pamati
+  logs_tab_delimited = False
+  
   def _log_tab_delimited(self, cite_url, origin_ut, text):
     pass
   
+  def _tee_tab_delimited(self, lines, cite_url, origin_ut):
+    seen = []
+    for line in lines:
+      seen.append(line)
+      yield line
+    self._log_tab_delimited(cite_url, origin_ut, u'\n'.join(seen))
+  
+  def _export_form(self, qid, origin_ut):
+    sid = self._get_sid()
+    data = OrderedDict()
+    data['selectedIds'] = ''
+    data['viewType'] = 'summary'
+    data['product'] = 'WOS'
+    data['rurl'] = quote('http://apps.webofknowledge.com/summary.do?SID={sid}&SID={sid}&product=WOS&product=WOS&UT={ut}&qid=6&search_mode=CitingArticles&mode=CitingArticles'.format(sid=quote(sid, ''), ut=quote(origin_ut, '')), '')
+    data['mark_id'] = 'WOS'
+    data['colName'] = 'WOS'
+    data['search_mode'] = 'CitingArticles'
+    data['locale'] = 'en_US'
+    data['view_name'] = 'WOS-CitingArticles-summary'
+    data['sortBy'] = 'PY.D;LD.D;SO.A;VL.D;PG.A;AU.A'
+    data['mode'] = 'OpenOutputService'
+    data['qid'] = qid
+    data['SID'] = sid
+    data['format'] = 'saveToFile'
+    data['filters'] = 'USAGEIND AUTHORSIDENTIFIERS ACCESSION_NUM FUNDING SUBJECT_CATEGORY JCR_CATEGORY LANG IDS PAGEC SABBR CITREFC ISSN PUBINFO KEYWORDS CITTIMES ADDRS CONFERENCE_SPONSORS DOCTYPE ABSTRACT CONFERENCE_INFO SOURCE TITLE AUTHORS  '
+    data['mark_to'] = ''
+    data['mark_from'] = ''
+    data['count_new_items_marked'] = '0'
+    data['value(record_select_type)'] = 'range'
+    data['markFrom'] = ''
+    data['markTo'] = ''
+    data['fields_selection'] = 'USAGEIND AUTHORSIDENTIFIERS ACCESSION_NUM FUNDING SUBJECT_CATEGORY JCR_CATEGORY LANG IDS PAGEC SABBR CITREFC ISSN PUBINFO KEYWORDS CITTIMES ADDRS CONFERENCE_SPONSORS DOCTYPE ABSTRACT CONFERENCE_INFO SOURCE TITLE AUTHORS  '
+    data['save_options'] = 'tabMacUTF8'
+    return data
+  
+  def _export_range(self, form, page, headers, cite_url, origin_ut):
+    data = OrderedDict(form)
+    data['mark_to'] = data['markTo'] = str(page.end_index)
+    data['mark_from'] = data['markFrom'] = str(page.start_index)
+    
+    # request konci az ked je export cely stiahnuty (alebo zatvoreny), aby sa
+    # finished_delay aj latencia pre adaptivny throttling pocitali od konca tela
+    with self.throttler(BULK) as request:
+      r2 = self.session.post('http://apps.webofknowledge.com/OutboundService.do?action=go&&', data=data, headers=headers, stream=True)
+      request.check_status(r2.status_code)
+      
+      # export citame po riadkoch, publikacie idu dalej uz pocas stahovania
+      r2.encoding = 'UTF-8'
+      with closing(r2):
+        lines = iter_lines(r2.iter_content(64 * 1024, decode_unicode=True))
+        if self.logs_tab_delimited:
+          lines = self._tee_tab_delimited(lines, cite_url, origin_ut)
+        for pub in self._parse_tab_delimited(lines):
+          yield pub
+  
   def _get_citations_from_url(self, cite_url, origin_ut):
-    with self.throttler():
+    with self.throttler(BULK) as request:
       r = self.session.get(cite_url)
+      request.check_status(r.status_code)
     count = self._parse_citations_list(r.text)
     
     if count == 0:
       return
     
-    for page in pages(count, 500, end_inclusive=True):
-      mark_from = str(page.start_index)
-      mark_to = str(page.end_index)
-      qid = re.search(r'qid=(\d+)', r.text).group(1)
-      
-      headers = {'Referer': r.url}
-      
-      data = OrderedDict()
-      data['selectedIds'] = ''
-      data['viewType'] = 'summary'
-      data['product'] = 'WOS'
-      data['rurl'] = quote('http://apps.webofknowledge.com/summary.do?SID={sid}&SID={sid}&product=WOS&product=WOS&UT={ut}&qid=6&search_mode=CitingArticles&mode=CitingArticles'.format(sid=quote(self._get_sid(), ''), ut=quote(origin_ut, '')), '')
-      data['mark_id'] = 'WOS'
-      data['colName'] = 'WOS'
-      data['search_mode'] = 'CitingArticles'
-      data['locale'] = 'en_US'
-      data['view_name'] = 'WOS-CitingArticles-summary'
-      data['sortBy'] = 'PY.D;LD.D;SO.A;VL.D;PG.A;AU.A'
-      data['mode'] = 'OpenOutputService'
-      data['qid'] = qid
-      data['SID'] = self._get_sid()
-      data['format'] = 'saveToFile'
-      data['filters'] = 'USAGEIND AUTHORSIDENTIFIERS ACCESSION_NUM FUNDING SUBJECT_CATEGORY JCR_CATEGORY LANG IDS PAGEC SABBR CITREFC ISSN PUBINFO KEYWORDS CITTIMES ADDRS CONFERENCE_SPONSORS DOCTYPE ABSTRACT CONFERENCE_INFO SOURCE TITLE AUTHORS  '
-      data['mark_to'] = mark_to
-      data['mark_from'] = mark_from
-      data['count_new_items_marked'] = '0'
-      data['value(record_select_type)'] = 'range'
-      data['markFrom'] = mark_from
-      data['markTo'] = mark_to
-      data['fields_selection'] = 'USAGEIND AUTHORSIDENTIFIERS ACCESSION_NUM FUNDING SUBJECT_CATEGORY JCR_CATEGORY LANG IDS PAGEC SABBR CITREFC ISSN PUBINFO KEYWORDS CITTIMES ADDRS CONFERENCE_SPONSORS DOCTYPE ABSTRACT CONFERENCE_INFO SOURCE TITLE AUTHORS  '
-      data['save_options'] = 'tabMacUTF8'
-      
-      with self.throttler():
-        r2 = self.session.post('http://apps.webofknowledge.com/OutboundService.do?action=go&&', data=data, headers=headers)
-      
-      r2.encoding = 'UTF-8'
-      self._log_tab_delimited(cite_url, origin_ut, r2.text)
-      
-      for pub in self._parse_tab_delimited(r2.text):
-        yield pub
+    qid = re.search(r'qid=(\d+)', r.text).group(1)
+    form = self._export_form(qid, origin_ut)
+    headers = {'Referer': r.url}
+    page_list = list(pages(count, 500, end_inclusive=True))
+    
+    workers = min(self.export_workers, len(page_list))
+    if workers <= 1:
+      for page in page_list:
+        for pub in self._export_range(form, page, headers, cite_url, origin_ut):
+          yield pub
+      return
+    
+    # rozsahy sa stahuju a parsuju naraz, vraciame ich v poradi, hned ako je dalsi hotovy
+    def export(page):
+      return list(self._export_range(form, page, headers, cite_url, origin_ut))
+    pool = ThreadPool(workers)
+    try:
+      for pubs in pool.imap(export, page_list):
+        for pub in pubs:
+          yield pub
+    finally:
+      # ak nas prestanu citat, zvysne rozsahy uz nezaciname
+      pool.terminate()
+      pool.join()
   
-  def _parse_tab_delimited(self, text):
-    lines = text.splitlines()
-    columns = lines[0].split('\t')
+  def _parse_tab_delimited(self, lines):
+    """Parsuje export po riadkoch, lines moze byt iterator riadkov alebo cely text"""
+    if isinstance(lines, basestring):
+      lines = lines.splitlines()
+    lines = iter(lines)
+    header = next(lines, None)
+    if header == None:
+      return
+    columns = header.lstrip(u'\ufeff').split('\t')
     try:
       col_authors = columns.index('AF')
     except ValueError:
@@ -617,8 +838,14 @@ class WokWebConnection(DataSourceConnection):
     col_publisher = columns.index('PU')
     col_publisher_city = columns.index('PI')
     col_edition = columns.index('SE')
-    for line in lines[1:]:
-      data = line.split('\t')
+    # stlpce za poslednym pouzivanym (abstrakt, adresy, ...) nerozdelujeme
+    last_col = max(col_authors, col_title, col_source, col_year, col_issn, col_isbn, col_doi, col_id,
+                   col_begin_page, col_end_page, col_article_no, col_book_series, col_volume, col_issue,
+                   col_special_issue, col_supplement, col_publisher, col_publisher_city, col_edition)
+    for line in lines:
+      if not line:
+        continue
+      data = line.split('\t', last_col + 1)
       pub = Publication(data[col_title], Author.parse_sn_first_list(data[col_authors]), int(data[col_year]))
       if data[col_source]:
         pub.published_in = data[col_source]
@@ -653,6 +880,11 @@ class WokWebConnection(DataSourceConnection):
         pub.identifiers.append(Identifier(data[col_doi], type='DOI'))
       yield pub
   
+  def can_search_citations(self, publication):
+    if len(Identifier.find_by_type(publication.identifiers, 'WOK')) == 0:
+      return False
+    return len(URL.find_by_type(publication.cite_urls, 'WOK')) > 0
+  
   def search_citations(self, publications):
     for publication in publications:
       ut = list(Identifier.find_by_type(publication.identifiers, 'WOK'))
@@ -667,7 +899,7 @@ class WokWebConnection(DataSourceConnection):
     pass
     
   def close(self):
-    self.session.close()
+    self.sessions.checkin(self.session)
 
 class Wok(DataSource):
   def __init__(self, ws=None, web=None, lamr=None):
@@ -712,6 +944,15 @@ class WokConnection(DataSourceConnection):
     self.assign_indexes(citations)
     return citations
   
+  def can_search_citations(self, publication):
+    return self.webconn.can_search_citations(publication)
+  
+  def search_citations_by_publication(self, publications):
+    results = self.webconn.search_citations_by_publication(publications)
+    # indexy zistujeme pre citacie vsetkych publikacii naraz
+    self.assign_indexes([pub for citations in results if citations is not None for pub in citations])
+    return results
+  
   def assign_indexes(self, publications):
     return self.wsconn.assign_indexes(publications)
   